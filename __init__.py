@@ -7,7 +7,7 @@ from wizard import (
     FailureStart, UpdateMagentoCatalogStart, UpdateMagentoCatalog,
     SuccessStart, ExportDataWizardConfigure, ExportDataWizard,
 )
-from channel import Channel, MagentoTier
+from channel import Channel, ChannelOrderState, TaxMapping, MagentoTier
 from party import Party, MagentoWebsiteParty, Address
 from product import (
     Category, MagentoInstanceCategory, Product,
@@ -29,6 +29,8 @@ def register():
     """
     Pool.register(
         Channel,
+        ChannelOrderState,
+        TaxMapping,
         MagentoTier,
         TestMagentoConnectionStart,
         ImportStoresStart,
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
+import threading
+import xmlrpclib
+from collections import defaultdict
+from contextlib import contextmanager
+from urlparse import urlparse
+
 from magento.api import API
 
+#: Fault code sent by magento when the session has expired
+SESSION_EXPIRED = 5
+
 
 class Core(API):
     """
@@ -79,3 +88,143 @@ class OrderConfig(API):
                          ]
         """
         return self.call('sales_order.shipping_methods', [])
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport which puts a timeout on the socket of its connection,
+    so that a request to a magento instance which does not answer fails
+    with `socket.timeout` instead of blocking forever.
+
+    The timeout can be changed between requests, it is applied to the
+    connection every time it is used.
+    """
+
+    base = xmlrpclib.Transport
+
+    def __init__(self, timeout=None, use_datetime=0):
+        self.base.__init__(self, use_datetime)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = self.base.make_connection(self, host)
+        connection.timeout = self.timeout
+        if connection.sock is not None:
+            # The connection is kept alive and reused
+            connection.sock.settimeout(self.timeout)
+        return connection
+
+
+class SafeTimeoutTransport(TimeoutTransport, xmlrpclib.SafeTransport):
+    """
+    HTTPS version of `TimeoutTransport`
+    """
+
+    base = xmlrpclib.SafeTransport
+
+
+def get_transport(url, timeout=None):
+    """
+    Returns a transport for the given url with the given timeout
+
+    :param url: URL of the magento instance
+    :param timeout: Seconds after which a request fails, None to wait forever
+    """
+    if urlparse(url).scheme == 'https':
+        return SafeTimeoutTransport(timeout)
+    return TimeoutTransport(timeout)
+
+
+class PooledResource(object):
+    """
+    Wraps an API resource bound to a pooled session. If magento reports the
+    session as expired, the resource logs in again on the same connection
+    and the call is retried once.
+    """
+
+    __slots__ = ('api', )
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        attribute = getattr(self.api, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            except xmlrpclib.Fault, fault:
+                if fault.faultCode != SESSION_EXPIRED:
+                    raise
+                # Login again using the same connection
+                self.api.__enter__()
+                return attribute(*args, **kwargs)
+        return call
+
+
+class SessionPool(object):
+    """
+    Pool of authenticated magento sessions.
+
+    Sessions are pooled per instance credentials and shared by all API
+    resources, so that the login and the TCP/TLS handshake are done once per
+    connection instead of once for every `with` block. A session is used by
+    only one thread at a time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+
+    @contextmanager
+    def resource(self, resource, url, username, password, timeout=None):
+        """
+        Context manager which yields an instance of the given API resource
+        bound to a pooled session.
+
+        :param resource: API class like `magento.Order`
+        :param timeout: Seconds after which a request on the session fails
+                        with `socket.timeout`, None to wait forever
+        """
+        key = (url, username, password)
+        with self.lock:
+            connection = self.idle[key] and self.idle[key].pop() or None
+
+        if connection is None:
+            transport = get_transport(url, timeout)
+            api = resource(url, username, password, transport=transport)
+            api = api.__enter__()
+        else:
+            api = resource(url, username, password)
+            api.client, api.session, transport = connection
+            transport.timeout = timeout
+
+        broken = False
+        try:
+            yield PooledResource(api)
+        except (IOError, xmlrpclib.ProtocolError):
+            # Do not put a broken connection back to the pool
+            broken = True
+            raise
+        finally:
+            if not broken:
+                self.release(key, api, transport)
+
+    def release(self, key, api, transport):
+        """
+        Put the session of the api back to the pool
+        """
+        with self.lock:
+            self.idle[key].append((api.client, api.session, transport))
+
+    def clear(self):
+        """
+        Forget all the pooled sessions
+        """
+        with self.lock:
+            self.idle.clear()
+
+
+session_pool = SessionPool()
@@ -1,20 +1,26 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from collections import defaultdict
 from dateutil.relativedelta import relativedelta
 
 import magento
 import logging
+import hashlib
+import json
+import time
 import xmlrpclib
 import socket
+from multiprocessing.pool import ThreadPool
 
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, fields
-from .api import OrderConfig
+from .api import OrderConfig, session_pool
 
 __metaclass__ = PoolMeta
-__all__ = ['Channel', 'MagentoTier']
+__all__ = ['Channel', 'ChannelOrderState', 'TaxMapping', 'MagentoTier']
 
 MAGENTO_STATES = {
     'invisible': ~(Eval('source') == 'magento'),
@@ -27,6 +33,13 @@ INVISIBLE_IF_NOT_MAGENTO = {
 
 logger = logging.getLogger('magento')
 
+#: Overlap with the last order import, see
+#: `Channel.get_magento_order_import_start`
+ORDER_IMPORT_OVERLAP = relativedelta(minutes=10)
+
+#: Number of magento channels processed at the same time by the crons
+CRON_CHANNEL_WORKERS = 4
+
 
 def batch(iterable, n=1):
     l = len(iterable)
@@ -100,6 +113,75 @@ class Channel:
     magento_payment_gateways = fields.One2Many(
         'magento.instance.payment_gateway', 'channel', 'Payments',
     )
+    magento_batch_size = fields.Integer(
+        'Batch Size', states=INVISIBLE_IF_NOT_MAGENTO, depends=['source'],
+        help='Number of records sent to or fetched from magento in a single '
+        'request'
+    )
+    magento_order_import_workers = fields.Integer(
+        'Order Import Workers', states=INVISIBLE_IF_NOT_MAGENTO,
+        depends=['source'], help='Number of orders imported in parallel. '
+        'Each order is then imported and committed in its own transaction.'
+    )
+    magento_product_import_page_size = fields.Integer(
+        'Product Import Page Size', states=INVISIBLE_IF_NOT_MAGENTO,
+        depends=['source'], help='Number of products imported and committed '
+        'at a time while importing the catalog'
+    )
+    #: The magento ID of the last product of the last page which was
+    #: imported and committed. An interrupted product import resumes from
+    #: the product after this one.
+    magento_last_product_import_id = fields.Integer(
+        'Last Imported Product ID', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_cron_timeout = fields.Integer(
+        'Cron Timeout', states=INVISIBLE_IF_NOT_MAGENTO, depends=['source'],
+        help='Seconds a request to magento and the crons may take for this '
+        'channel before they give up on it'
+    )
+    magento_inventory_batch_size = fields.Integer(
+        'Inventory Batch Size', states=INVISIBLE_IF_NOT_MAGENTO,
+        depends=['source'], help='Number of products whose inventory is '
+        'sent to magento in a single request'
+    )
+    magento_inventory_adaptive_batch = fields.Boolean(
+        'Adaptive Inventory Batch Size', states=INVISIBLE_IF_NOT_MAGENTO,
+        depends=['source'], help='Grow the inventory batches while magento '
+        'responds within the target latency, and shrink them when it is '
+        'slower, times out or returns faults'
+    )
+    magento_inventory_target_latency = fields.Float(
+        'Inventory Target Latency', states={
+            'invisible': ~(Eval('source') == 'magento') |
+            ~Eval('magento_inventory_adaptive_batch'),
+        }, depends=['source', 'magento_inventory_adaptive_batch'],
+        help='Seconds within which magento is expected to respond to an '
+        'inventory batch'
+    )
+    #: The magento ID of the last order of the last page of order summaries
+    #: which was imported and committed, along with the time the
+    #: interrupted order import was started. An interrupted order import
+    #: resumes from the order after this one.
+    magento_last_order_import_id = fields.Integer(
+        'Last Imported Order ID', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_started = fields.DateTime(
+        'Order Import Started', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    #: JSON list of the summaries of the orders which failed to import in
+    #: parallel. They are attempted again by the next order import.
+    magento_order_import_retries = fields.Text(
+        'Orders To Retry', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    _magento_tryton_action_cache = Cache(
+        'sale.channel.get_tryton_action', context=False
+    )
+    _magento_tax_cache = Cache('sale.channel.get_magento_tax', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -120,7 +202,7 @@ class Channel:
             "multiple_channels": 'Selected operation can be done only for one'
                 ' channel at a time',
             'invalid_magento_channel':
-                'Current channel does not belongs to Magento !'
+                'Current channel does not belongs to Magento !',
         })
         cls._buttons.update({
             'import_magento_carriers': {
@@ -162,6 +244,56 @@ class Channel:
         """
         return 1
 
+    @staticmethod
+    def default_magento_batch_size():
+        """
+        Sets default batch size for bulk requests to magento
+        """
+        return 50
+
+    @staticmethod
+    def default_magento_order_import_workers():
+        """
+        Sets default number of order import workers. Orders are imported one
+        after the other in the current transaction by default.
+        """
+        return 1
+
+    @staticmethod
+    def default_magento_inventory_batch_size():
+        """
+        Sets default inventory batch size
+        """
+        return 50
+
+    @staticmethod
+    def default_magento_inventory_adaptive_batch():
+        """
+        Inventory batches are of a fixed size by default
+        """
+        return False
+
+    @staticmethod
+    def default_magento_inventory_target_latency():
+        """
+        Sets default target latency of inventory batches
+        """
+        return 5.0
+
+    @staticmethod
+    def default_magento_cron_timeout():
+        """
+        Sets default cron timeout
+        """
+        return 600
+
+    @staticmethod
+    def default_magento_product_import_page_size():
+        """
+        Sets default page size for product import
+        """
+        return 100
+
     def import_order_states(self):
         """
         Import order states for magento channel
@@ -173,10 +305,7 @@ class Channel:
 
         with Transaction().set_context({'current_channel': self.id}):
             # Import order states
-            with OrderConfig(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as order_config_api:
+            with self.get_magento_api(OrderConfig) as order_config_api:
                 order_states_data = order_config_api.get_states()
                 for code, name in order_states_data.iteritems():
                     self.create_order_state(code, name)
@@ -210,6 +339,35 @@ class Channel:
         ):
             self.raise_user_error("connection_error")
 
+    def get_magento_api(self, resource):
+        """
+        Returns a context manager which yields the given magento API resource
+        bound to a pooled session of this channel. The session is shared with
+        the other resources and reused across calls instead of logging in
+        every time.
+
+        :param resource: API class like `magento.Order`
+        """
+        return session_pool.resource(
+            resource, self.magento_url, self.magento_api_user,
+            self.magento_api_key, timeout=self.get_magento_timeout()
+        )
+
+    def get_magento_timeout(self):
+        """
+        Returns the seconds a request to magento may take for this channel.
+        It is the `magento_cron_timeout`, cut down to the time left until the
+        `magento_deadline` in the context if there is one.
+        """
+        timeout = self.magento_cron_timeout or \
+            self.default_magento_cron_timeout()
+        deadline = Transaction().context.get('magento_deadline')
+        if deadline is not None:
+            # Leave at least a second to the request, a zero timeout would
+            # make the socket non blocking
+            timeout = min(timeout, max(deadline - time.time(), 1))
+        return timeout
+
     @classmethod
     def get_current_magento_channel(cls):
         """Helper method to get the current magento_channel.
@@ -234,10 +392,7 @@ class Channel:
             assert channel.source == 'magento'
 
             with Transaction().set_context({'current_channel': channel.id}):
-                with OrderConfig(
-                    channel.magento_url, channel.magento_api_user,
-                    channel.magento_api_key
-                ) as order_config_api:
+                with channel.get_magento_api(OrderConfig) as order_config_api:
                     carriers_data = order_config_api.get_shipping_methods()
 
             carriers = []
@@ -259,30 +414,76 @@ class Channel:
 
             SaleChannelCarrier.create(carriers)
 
+    def get_magento_product_pages(self):
+        """
+        Generator which yields the products of this magento channel in pages
+        of `magento_product_import_page_size` products, ordered by their
+        magento ID. Products up to `magento_last_product_import_id` are
+        skipped, so that an interrupted import resumes from the last page
+        which was not completely imported.
+
+        :return: Generator of lists of tuples (magento product ID, SKU)
+        """
+        filters = {}
+        if self.magento_last_product_import_id:
+            filters['product_id'] = {
+                'gt': self.magento_last_product_import_id
+            }
+
+        with self.get_magento_api(magento.Product) as product_api:
+            # XXX: catalog_product.list does not support pagination, so only
+            # the lean summary (ID and SKU) is kept in memory and paginated
+            # here.
+            magento_products = sorted([
+                (int(product['product_id']), product['sku'])
+                for product in product_api.list(filters)
+            ])
+
+        page_size = self.magento_product_import_page_size or \
+            self.default_magento_product_import_page_size()
+        for page in batch(magento_products, page_size):
+            yield page
+
     def import_products(self):
         """
         Import products for this magento channel
 
         Downstream implementation for channel.import_products
+
+        The products are imported page by page with `get_magento_products`
+        and each page is committed once it is imported. If the import is
+        interrupted, the next import resumes from the page after the last
+        committed one.
+
+        :return: List of active records of products imported
         """
+        Product = Pool().get('product.product')
+
         if self.source != 'magento':
             return super(Channel, self).import_products()
 
         self.import_category_tree()
 
+        # Only the IDs of the products of the committed pages are kept
+        product_ids = []
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Product(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as product_api:
-                # TODO: Implement pagination and import each product as async
-                # task
-                magento_products = product_api.list()
+            for page in self.get_magento_product_pages():
+                product_ids.extend(
+                    product.id for product in self.get_magento_products([
+                        sku for magento_id, sku in page
+                    ]).itervalues()
+                )
 
-                products = []
-                for magento_product in magento_products:
-                    products.append(self.import_product(magento_product['sku']))
+                self.write([self], {
+                    'magento_last_product_import_id': page[-1][0],
+                })
+                Transaction().cursor.commit()
 
-        return products
+        # The whole catalog is imported, the next import starts afresh
+        self.write([self], {
+            'magento_last_product_import_id': None,
+        })
+        return Product.browse(product_ids)
 
     def import_product(self, sku, product_data=None):
         """
@@ -314,10 +515,7 @@ class Channel:
         if not products or not listings:
             # Either way we need the product data from magento. Make that
             # dreaded API call.
-            with magento.Product(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as product_api:
+            with self.get_magento_api(magento.Product) as product_api:
                 product_data = product_api.info(sku, identifierType="sku")
 
                 # XXX: sanitize product_data, sometimes product sku may
@@ -338,6 +536,67 @@ class Channel:
 
         return product
 
+    def get_magento_products(self, skus):
+        """
+        Bulk version of `import_product`.
+
+        Products and listings of the given SKUs are searched with a single
+        query per model. Only the SKUs which miss a product or a listing
+        are fetched from magento, using a multiCall for each batch of
+        `magento_batch_size` SKUs. SKUs for which magento returns a fault
+        are logged and skipped.
+
+        :param skus: List of SKUs
+        :return: Dictionary of SKU and active record of product
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+
+        # Sanitize SKUs
+        skus = set(sku.strip() for sku in skus if sku and sku.strip())
+        if not skus:
+            return {}
+
+        products = dict(
+            (product.code, product) for product in Product.search([
+                ('code', 'in', list(skus)),
+            ])
+        )
+        listed_skus = set(
+            listing.product.code for listing in Listing.search([
+                ('product.code', 'in', list(skus)),
+                ('channel', '=', self.id),
+            ])
+        )
+
+        missing_skus = sorted(skus - listed_skus)
+        batch_size = self.magento_batch_size or \
+            self.default_magento_batch_size()
+        for missing_skus_batch in batch(missing_skus, batch_size):
+            with self.get_magento_api(magento.Product) as product_api:
+                products_data = product_api.multiCall([
+                    ['catalog_product.info', [sku, None, None, 'sku']]
+                    for sku in missing_skus_batch
+                ])
+
+            for sku, product_data in zip(missing_skus_batch, products_data):
+                if product_data.get('isFault'):
+                    logger.warning("Product %s: %s %s" % (
+                        sku, product_data['faultCode'],
+                        product_data['faultMessage']
+                    ))
+                    continue
+
+                # XXX: sanitize product_data, sometimes product sku may
+                # contain trailing spaces
+                product_data['sku'] = product_data['sku'].strip()
+
+                if sku not in products:
+                    products[sku] = Product.create_from(self, product_data)
+                Listing.create_from(self, product_data)
+
+        return products
+
     def import_category_tree(self):
         """
         Imports the category tree and creates categories in a hierarchy same as
@@ -350,26 +609,88 @@ class Channel:
         self.validate_magento_channel()
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Category(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as category_api:
+            with self.get_magento_api(magento.Category) as category_api:
                 category_tree = category_api.tree(
                     self.magento_root_category_id
                 )
                 Category.create_tree_using_magento_data(category_tree)
 
+    def get_magento_order_import_start(self):
+        """
+        Returns the time from which orders updated on magento are imported.
+
+        This is the high-water mark `last_order_import_time` less an overlap
+        of `ORDER_IMPORT_OVERLAP`, which covers the orders saved on magento
+        while the last import was running and clock skew between the
+        servers. If orders were never imported, orders of the last 30 days
+        are imported.
+
+        :return: UTC datetime
+        """
+        if self.last_order_import_time:
+            return self.last_order_import_time - ORDER_IMPORT_OVERLAP
+        return datetime.utcnow() - relativedelta(days=30)
+
+    def get_magento_order_summary_pages(self, order_api, filters):
+        """
+        Generator which yields the order summaries matching the given filters
+        page by page, as they are fetched from magento.
+
+        Every page is the first page of the orders after the last order of
+        the previous page, as magento returns the orders sorted by their
+        ID. Orders which stop matching the filters while a page is imported
+        would shift the later page numbers and hide the order at each page
+        boundary, but they do not shift the IDs. Orders up to
+        `magento_last_order_import_id` are skipped, so that an interrupted
+        import resumes after the last committed page.
+
+        :param order_api: Magento order API
+        :param filters: Filters for the orders to be fetched
+        :return: Generator of tuples (magento ID of the last order of the
+                 page, list of order summaries)
+        """
+        last_order_id = self.magento_last_order_import_id or 0
+        has_next = True
+        while has_next:
+            # XXX: Pagination is only available in
+            # magento extension >= 1.6.1
+            api_res = order_api.search(
+                filters=dict(filters, order_id={'gt': last_order_id}),
+                limit=3000, page=1
+            )
+            has_next = api_res['hasNext']
+            if not api_res['items']:
+                break
+            last_order_id = max(
+                int(summary['order_id']) for summary in api_res['items']
+            )
+            yield last_order_id, api_res['items']
+
     def import_orders(self):
         """
         Downstream implementation of channel.import_orders
 
+        Only the orders updated since the last successful import are
+        fetched. The order summaries are imported and committed page by
+        page, and the last order of the page imported last is recorded on
+        the channel. If the import is interrupted, the next import resumes
+        from the order after it, over the same window.
+
+        The high-water mark `last_order_import_time` is advanced only once
+        every page is imported. Orders which fail to import in parallel are
+        recorded in `magento_order_import_retries` instead of holding the
+        mark back, and are attempted again first by the next import.
+
         :return: List of active record of sale imported
         """
         if self.source != 'magento':
             return super(Channel, self).import_orders()
 
-        # Last one month order
-        updated_at_min = datetime.now() - relativedelta(days=30)
+        # A resumed import completes the window of the interrupted one, so
+        # the mark is set to the time that import was started.
+        import_started = self.magento_order_import_started or \
+            datetime.utcnow()
+        updated_at_min = self.get_magento_order_import_start()
         new_sales = []
         with Transaction().set_context({'current_channel': self.id}):
             order_states = self.get_order_states_to_import()
@@ -377,37 +698,245 @@ class Channel:
                 lambda state: state.code, order_states
             )
 
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
-                # Filter orders store_id using list()
-                # then get info of each order using info()
-                # and call find_or_create_using_magento_data on sale
-                filter = {
+            # Orders which failed in earlier imports are attempted again.
+            # Those failing again are recorded for the next import.
+            retries = json.loads(self.magento_order_import_retries or '[]')
+            if retries:
+                self.write([self], {'magento_order_import_retries': None})
+                new_sales.extend(self.import_magento_orders(retries))
+                Transaction().cursor.commit()
+
+            with self.get_magento_api(magento.Order) as order_api:
+                filters = {
                     'store_id': {'=': self.magento_store_id},
                     'state': {'in': order_states_to_import_in},
-                    'updated_at': {'gteq': updated_at_min.isoformat(' ')},
+                    'updated_at': {
+                        'gteq': updated_at_min.strftime('%Y-%m-%d %H:%M:%S')
+                    },
                 }
-                self.write([self], {
-                    'last_order_import_time': datetime.utcnow()
-                })
-                page = 1
-                has_next = True
-                orders_summaries = []
-                while has_next:
-                    # XXX: Pagination is only available in
-                    # magento extension >= 1.6.1
-                    api_res = order_api.search(
-                        filters=filter, limit=3000, page=page
+                for last_order_id, order_summaries in \
+                        self.get_magento_order_summary_pages(
+                            order_api, filters):
+                    new_sales.extend(
+                        self.import_magento_orders(order_summaries)
                     )
-                    has_next = api_res['hasNext']
-                    page += 1
-                    orders_summaries.extend(api_res['items'])
-
-                for order_summary in orders_summaries:
-                    new_sales.append(self.import_order(order_summary))
+                    self.write([self], {
+                        'magento_last_order_import_id': last_order_id,
+                        'magento_order_import_started': import_started,
+                    })
+                    Transaction().cursor.commit()
+
+        # The whole window is imported, the next import starts afresh from
+        # the new high-water mark
+        self.write([self], {
+            'last_order_import_time': import_started,
+            'magento_last_order_import_id': None,
+            'magento_order_import_started': None,
+        })
         return new_sales
 
+    def import_magento_orders(self, order_summaries):
+        """
+        Import the orders of the given summaries. Details of the orders
+        which are not imported yet are fetched in batches using
+        `get_magento_orders_data`.
+
+        The customers and products of all the orders are found or created in
+        bulk before the sales are built, and the sales are built with them.
+
+        If more than one `magento_order_import_workers` is configured, the
+        orders are imported in parallel using
+        `import_magento_orders_in_parallel`.
+
+        :param order_summaries: List of order summaries from magento
+        :return: List of active records of sales
+        """
+        Sale = Pool().get('sale.sale')
+        Party = Pool().get('party.party')
+
+        sales = []
+        increment_ids = []
+        magento_ids = set([])
+        with Transaction().set_context({'current_channel': self.id}):
+            # Orders already imported are skipped before any other work
+            existing_sales = Sale.find_using_magento_ids([
+                summary['order_id'] for summary in order_summaries
+            ])
+            for order_summary in order_summaries:
+                # The same order must never be imported twice
+                magento_id = int(order_summary['order_id'])
+                if magento_id in magento_ids:
+                    continue
+                magento_ids.add(magento_id)
+
+                if magento_id in existing_sales:
+                    sales.append(existing_sales[magento_id])
+                else:
+                    increment_ids.append(order_summary['increment_id'])
+
+            orders_data = list(self.get_magento_orders_data(increment_ids))
+
+            # Resolve the customers and products of all the orders before
+            # any sale is built
+            party_ids = dict(
+                (magento_id, party.id) for magento_id, party in
+                Party.find_or_create_using_magento_ids([
+                    order_data['customer_id'] for order_data in orders_data
+                ]).iteritems()
+            )
+            product_ids = dict(
+                (sku, product.id) for sku, product in
+                self.get_magento_products([
+                    item['sku']
+                    for order_data in orders_data
+                    for item in order_data['items']
+                ]).iteritems()
+            )
+
+            if (self.magento_order_import_workers or 1) > 1:
+                sales.extend(self.import_magento_orders_in_parallel(
+                    orders_data, party_ids=party_ids, product_ids=product_ids
+                ))
+            else:
+                for order_data in orders_data:
+                    sales.append(Sale.create_using_magento_data(
+                        order_data, party_ids=party_ids,
+                        product_ids=product_ids
+                    ))
+        return sales
+
+    def import_magento_orders_in_parallel(
+        self, orders_data, party_ids=None, product_ids=None
+    ):
+        """
+        Import the orders using a pool of `magento_order_import_workers`
+        threads. Each order is imported and committed in its own
+        transaction, so an order which fails to import does not roll back
+        the others. Failed orders are logged and recorded in
+        `magento_order_import_retries`, to be attempted again by the next
+        import.
+
+        The workers cannot see the rows the others did not commit yet, so
+        the orders of a customer are all imported by the same worker, one
+        after the other. This way the addresses of the customer are found
+        or created only once.
+
+        The current transaction is committed first, as the workers can only
+        see committed data.
+
+        :param orders_data: List of order data from magento
+        :param party_ids: Dictionary of magento customer ID and ID of the
+                          party, for the customers resolved beforehand
+        :param product_ids: Dictionary of SKU and ID of the product, for the
+                            products resolved beforehand
+        :return: List of active records of sales
+        """
+        Sale = Pool().get('sale.sale')
+
+        transaction = Transaction()
+        transaction.cursor.commit()
+
+        database_name = transaction.cursor.database_name
+        user = transaction.user
+        context = transaction.context.copy()
+        context['current_channel'] = self.id
+
+        def import_order(order_data):
+            with Transaction().start(
+                database_name, user, context=context
+            ) as worker_transaction:
+                Sale = Pool().get('sale.sale')
+                try:
+                    sale = Sale.find_or_create_using_magento_data(
+                        order_data, party_ids=party_ids,
+                        product_ids=product_ids
+                    )
+                    worker_transaction.cursor.commit()
+                except Exception:
+                    worker_transaction.cursor.rollback()
+                    # The unique constraint on (magento_id, channel) makes
+                    # sure that only one of the concurrent imports of an
+                    # order wins.
+                    sale = Sale.find_using_magento_data(order_data)
+                    if sale is None:
+                        logger.exception(
+                            "Order %s could not be imported" %
+                            order_data['increment_id']
+                        )
+                        failed.append({
+                            'order_id': order_data['order_id'],
+                            'increment_id': order_data['increment_id'],
+                        })
+                        return None
+                return sale and sale.id
+
+        def import_customer_orders(customer_orders_data):
+            return [
+                (order_data['order_id'], import_order(order_data))
+                for order_data in customer_orders_data
+            ]
+
+        # Guest orders get a party of their own, they can go to any worker
+        orders_by_customer = defaultdict(list)
+        for order_data in orders_data:
+            orders_by_customer[
+                order_data['customer_id'] or ('guest', order_data['order_id'])
+            ].append(order_data)
+
+        failed = []
+        sale_ids = {}
+        pool = ThreadPool(self.magento_order_import_workers)
+        try:
+            for customer_sale_ids in pool.map(
+                import_customer_orders, orders_by_customer.values()
+            ):
+                sale_ids.update(customer_sale_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed:
+            # Record the failed orders to be attempted again by the next
+            # import, without holding back the others
+            retries = json.loads(
+                self.__class__(self.id).magento_order_import_retries or '[]'
+            )
+            self.write([self], {
+                'magento_order_import_retries': json.dumps(retries + failed),
+            })
+
+        return [
+            sale_ids[order_data['order_id']] and
+            Sale(sale_ids[order_data['order_id']])
+            for order_data in orders_data
+        ]
+
+    def get_magento_orders_data(self, increment_ids):
+        """
+        Generator which fetches the details of the given orders from magento
+        in batches of `magento_batch_size` orders, with one multiCall per
+        batch. Orders for which magento returns a fault are logged and
+        skipped.
+
+        :param increment_ids: List of order increment IDs
+        :return: Generator of order data
+        """
+        batch_size = self.magento_batch_size or \
+            self.default_magento_batch_size()
+
+        for increment_ids_batch in batch(increment_ids, batch_size):
+            with self.get_magento_api(magento.Order) as order_api:
+                orders_data = order_api.info_multi(increment_ids_batch)
+
+            for i, order_data in enumerate(orders_data):
+                if order_data.get('isFault'):
+                    logger.warning("Order %s: %s %s" % (
+                        increment_ids_batch[i], order_data['faultCode'],
+                        order_data['faultMessage']
+                    ))
+                    continue
+                yield order_data
+
     def import_order(self, order_info):
         "Downstream implementation to import sale order from magento"
         if self.source != 'magento':
@@ -420,9 +949,7 @@ class Channel:
             return sale
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+            with self.get_magento_api(magento.Order) as order_api:
                 order_data = order_api.info(order_info['increment_id'])
                 return Sale.create_using_magento_data(order_data)
 
@@ -461,16 +988,56 @@ class Channel:
     def export_shipment_status_to_magento_using_cron(cls):
         """
         Export Shipment status for shipments using cron
+
+        The channels are processed concurrently by a pool of
+        `CRON_CHANNEL_WORKERS` threads, each channel in its own transaction.
+        A channel which fails is logged and does not affect the others.
+
+        Every channel gets a deadline of its `magento_cron_timeout` from the
+        moment a worker starts on it. The requests to magento of the channel
+        time out at the deadline, so a channel which hangs fails and releases
+        its worker for the channels still waiting.
         """
         channels = cls.search([('source', '=', 'magento')])
 
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        def export_shipment_status(channel_id, timeout):
+            worker_context = dict(
+                context, magento_deadline=time.time() + timeout
+            )
+            with Transaction().start(
+                database_name, user, context=worker_context
+            ) as worker_transaction:
+                Channel = Pool().get('sale.channel')
+                try:
+                    Channel(channel_id).export_shipment_status_to_magento()
+                    worker_transaction.cursor.commit()
+                except Exception:
+                    worker_transaction.cursor.rollback()
+                    logger.exception(
+                        "Shipment status export failed for channel %s" %
+                        channel_id
+                    )
+
+        pool = ThreadPool(min(CRON_CHANNEL_WORKERS, len(channels) or 1))
         for channel in channels:
-            channel.export_shipment_status_to_magento()
+            pool.apply_async(export_shipment_status, (
+                channel.id, channel.magento_cron_timeout or
+                cls.default_magento_cron_timeout()
+            ))
+        pool.close()
+        pool.join()
 
     def export_shipment_status_to_magento(self):
         """
         Exports shipment status for shipments to magento, if they are shipped
 
+        The shipments are created on magento with `create_magento_shipments`.
+
         :return: List of active record of shipment
         """
         Shipment = Pool().get('stock.shipment.out')
@@ -497,6 +1064,7 @@ class Channel:
         self.save()
 
         updated_sales = set([])
+        shipments_to_export = []
         for sale in sales:
             # Get the increment id from the sale reference
             increment_id = sale.reference[
@@ -504,61 +1072,110 @@ class Channel:
             ]
 
             for shipment in sale.shipments:
-                try:
-                    # Some checks to make sure that only valid shipments are
-                    # being exported
-                    if shipment.is_tracking_exported_to_magento or \
-                            shipment.state != 'done' or \
-                            shipment.magento_increment_id:
-                        continue
-                    updated_sales.add(sale)
-                    with magento.Shipment(
-                        self.magento_url, self.magento_api_user,
-                        self.magento_api_key
-                    ) as shipment_api:
-                        item_qty_map = {}
-                        for move in shipment.outgoing_moves:
-                            if isinstance(move.origin, SaleLine) \
-                                    and move.origin.magento_id:
-                                # This is done because there can be multiple
-                                # lines with the same product and they need
-                                # to be send as a sum of quanitities
-                                item_qty_map.setdefault(
-                                    str(move.origin.magento_id), 0
-                                )
-                                item_qty_map[str(move.origin.magento_id)] += \
-                                    move.quantity
-                        shipment_increment_id = shipment_api.create(
-                            order_increment_id=increment_id,
-                            items_qty=item_qty_map
+                # Some checks to make sure that only valid shipments are
+                # being exported
+                if shipment.is_tracking_exported_to_magento or \
+                        shipment.state != 'done' or \
+                        shipment.magento_increment_id:
+                    continue
+                updated_sales.add(sale)
+                item_qty_map = {}
+                for move in shipment.outgoing_moves:
+                    if isinstance(move.origin, SaleLine) \
+                            and move.origin.magento_id:
+                        # This is done because there can be multiple
+                        # lines with the same product and they need
+                        # to be send as a sum of quanitities
+                        item_qty_map.setdefault(
+                            str(move.origin.magento_id), 0
                         )
-                        Shipment.write(list(sale.shipments), {
-                            'magento_increment_id': shipment_increment_id,
-                        })
+                        item_qty_map[str(move.origin.magento_id)] += \
+                            move.quantity
+                shipments_to_export.append(
+                    (shipment, increment_id, item_qty_map)
+                )
 
-                        if self.magento_export_tracking_information and (
-                            hasattr(shipment, 'tracking_number') and
-                            hasattr(shipment, 'carrier') and
-                            shipment.tracking_number and shipment.carrier
-                        ):
-                            with Transaction().set_context(
-                                    current_channel=self.id):
-                                shipment.export_tracking_info_to_magento()
-                except xmlrpclib.Fault, fault:
-                    if fault.faultCode == 102:
-                        # A shipment already exists for this order,
-                        # we cannot do anything about it.
-                        # Maybe it was already exported earlier or was created
-                        # separately on magento
-                        # Hence, just continue
-                        continue
+        if not shipments_to_export:
+            return updated_sales
+
+        exported_shipments = self.create_magento_shipments(
+            shipments_to_export
+        )
+
+        if exported_shipments:
+            write_args = []
+            for shipment, shipment_increment_id in exported_shipments:
+                write_args.extend([[shipment], {
+                    'magento_increment_id': shipment_increment_id,
+                }])
+            Shipment.write(*write_args)
+
+        if self.magento_export_tracking_information:
+            with Transaction().set_context(current_channel=self.id):
+                for shipment, _ in exported_shipments:
+                    shipment = Shipment(shipment.id)
+                    if hasattr(shipment, 'tracking_number') and \
+                            hasattr(shipment, 'carrier') and \
+                            shipment.tracking_number and shipment.carrier:
+                        shipment.export_tracking_info_to_magento()
 
         return updated_sales
 
+    def create_magento_shipments(self, shipments_to_export):
+        """
+        Creates the given shipments on magento over a single session, in
+        batches of `magento_batch_size` shipments with one multiCall per
+        batch.
+
+        :param shipments_to_export: List of tuples of shipment active record,
+                                    order increment id and the quantities
+                                    shipped per magento order item
+        :return: List of tuples of shipment active record and the increment
+                 id of the shipment created on magento
+        """
+        batch_size = self.magento_batch_size or \
+            self.default_magento_batch_size()
+
+        exported_shipments = []
+        with self.get_magento_api(magento.Shipment) as shipment_api:
+            for shipments_batch in batch(shipments_to_export, batch_size):
+                # The arguments are the ones `magento.Shipment.create` sends
+                # by default: no comment, and the customer is notified by
+                # email without the comment.
+                results = shipment_api.multiCall([
+                    [
+                        'sales_order_shipment.create',
+                        [order_increment_id, items_qty, '', True, False]
+                    ] for _shipment, order_increment_id, items_qty
+                    in shipments_batch
+                ])
+                for (shipment, increment_id, _), result in zip(
+                        shipments_batch, results):
+                    if isinstance(result, dict) and result.get('isFault'):
+                        # A fault 102 means a shipment already exists for
+                        # this order. Maybe it was already exported earlier
+                        # or was created separately on magento, we cannot do
+                        # anything about it.
+                        if result['faultCode'] != '102':
+                            logger.warning("Shipment of order %s: %s %s" % (
+                                increment_id, result['faultCode'],
+                                result['faultMessage']
+                            ))
+                        continue
+                    exported_shipments.append((shipment, result))
+        return exported_shipments
+
     def export_product_prices(self):
         """
         Exports tier prices of products from tryton to magento for this channel
-        :return: List of products
+
+        The prices are computed up front with `get_magento_tier_prices` and
+        sent over a single session, in batches of `magento_batch_size`
+        listings with one multiCall per batch. A digest of the tier prices
+        exported is stored on each listing, and listings whose tier prices
+        did not change since are not sent again.
+
+        :return: Number of listings whose tier prices were exported
         """
         if self.source != 'magento':
             return super(Channel, self).export_product_prices()
@@ -585,44 +1202,140 @@ class Channel:
         self.last_product_price_export_time = datetime.utcnow()
         self.save()
 
-        for listing in product_listings:
+        tier_prices = self.get_magento_tier_prices(product_listings)
+
+        # Only the listings whose tier prices changed since they were last
+        # exported are sent to magento
+        digests = dict(
+            (listing_id, hashlib.sha1(
+                json.dumps(price_data, sort_keys=True)
+            ).hexdigest())
+            for listing_id, price_data in tier_prices.iteritems()
+        )
+        product_listings = [
+            listing for listing in product_listings
+            if listing.magento_tier_price_digest != digests[listing.id]
+        ]
+        if not product_listings:
+            return 0
+
+        batch_size = self.magento_batch_size or \
+            self.default_magento_batch_size()
+
+        exported_listings = defaultdict(list)
+        # Update tier prices to magento
+        with self.get_magento_api(
+            magento.ProductTierPrice
+        ) as tier_price_api:
+            for listings_batch in batch(product_listings, batch_size):
+                results = tier_price_api.multiCall([
+                    [
+                        'catalog_product_attribute_tier_price.update', [
+                            listing.product_identifier,
+                            tier_prices[listing.id],
+                            'productID'
+                        ]
+                    ] for listing in listings_batch
+                ])
+                for listing, result in zip(listings_batch, results):
+                    if isinstance(result, dict) and result.get('isFault'):
+                        logger.warning("Tier prices of %s: %s %s" % (
+                            listing.product_identifier, result['faultCode'],
+                            result['faultMessage']
+                        ))
+                        continue
+                    exported_listings[digests[listing.id]].append(listing)
+
+        if exported_listings:
+            write_args = []
+            for digest, listings in exported_listings.iteritems():
+                write_args.extend([listings, {
+                    'magento_tier_price_digest': digest,
+                }])
+            ChannelListing.write(*write_args)
 
-            # Get the price tiers from the product listing if the list has
-            # price tiers else get the default price tiers from current
-            # channel
+        return len(product_listings)
+
+    def get_magento_tier_prices(self, product_listings):
+        """
+        Compute the tier prices of the given listings before anything is
+        sent to magento, so that the listings whose tier prices did not
+        change can be left out. The tiers of a listing are its own price
+        tiers, or the default price tiers of the channel if it has none.
+
+        :param product_listings: List of active records of product listings
+        :return: Dictionary of listing ID to the price data to be sent to
+                 magento
+        """
+        tier_prices = {}
+        for listing in product_listings:
             price_tiers = listing.price_tiers or self.magento_price_tiers
 
             price_data = []
             for tier in price_tiers:
                 if hasattr(tier, 'product_listing'):
-                    # The price tier comes from a product listing, then it has a
-                    # function field for price, we use it directly
+                    # The price tier comes from a product listing, then it
+                    # has a function field for price, we use it directly
                     price = tier.price
                 else:
                     # The price tier comes from the default tiers on
-                    # channel,
-                    # we dont have a product on tier, so we use the current
-                    # product in loop for computing the price for this tier
+                    # channel, we dont have a product on tier, so we use
+                    # the product of the listing for computing the price
+                    # for this tier
                     price = self.price_list.compute(
                         None, listing.product, listing.product.list_price,
                         tier.quantity, self.default_uom
                     )
-
                 price_data.append({
                     'qty': tier.quantity,
                     'price': float(price),
                 })
+            tier_prices[listing.id] = price_data
 
-            # Update stock information to magento
-            with magento.ProductTierPrice(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as tier_price_api:
-                tier_price_api.update(
-                    listing.product_identifier, price_data,
-                    identifierType="productID"
-                )
+        return tier_prices
 
-        return len(product_listings)
+    def get_tryton_action(self, name):
+        """
+        Returns the tryton action for the order state of given code.
+
+        The action is memoized per channel until order states are modified,
+        so that the order states are not searched for every order imported.
+
+        :param name: Code of the magento order state
+        :return: A dictionary of tryton action and shipment and invoice
+                 methods
+        """
+        if self.source != 'magento':
+            return super(Channel, self).get_tryton_action(name)
+
+        key = (self.id, name)
+        tryton_action = self._magento_tryton_action_cache.get(key)
+        if tryton_action is None:
+            tryton_action = super(Channel, self).get_tryton_action(name)
+            self._magento_tryton_action_cache.set(key, tryton_action)
+
+        return dict(tryton_action)
+
+    def get_magento_tax(self, rate):
+        """
+        Returns the tax of given rate for this channel.
+
+        The taxes are memoized per channel and rate until the tax mapping
+        changes, so that order lines resolve their taxes without searching
+        them again.
+
+        :param rate: Rate of the tax as a fraction
+        :return: Active record of tax
+        """
+        Tax = Pool().get('account.tax')
+
+        key = (self.id, rate)
+        tax_id = self._magento_tax_cache.get(key)
+        if tax_id is None:
+            tax_id = self.get_tax(name=None, rate=rate).id
+            self._magento_tax_cache.set(key, tax_id)
+
+        return Tax(tax_id)
 
     def get_default_tryton_action(self, code, name):
         """
@@ -668,7 +1381,13 @@ class Channel:
             }
 
     def update_order_status(self):
-        "Downstream implementation of order_status update"
+        """
+        Downstream implementation of order_status update
+
+        The orders are fetched over a single session, in batches of
+        `magento_batch_size` orders. The status of all the orders is then
+        updated together.
+        """
         Sale = Pool().get('sale.sale')
 
         if self.source != 'magento':
@@ -678,29 +1397,86 @@ class Channel:
             ('channel', '=', self.id),
             ('state', 'in', ('confirmed', 'processing')),
         ])
-        order_ids = [sale.reference for sale in sales]
-        for order_ids_batch in batch(order_ids, 50):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+        sales_by_reference = dict((sale.reference, sale) for sale in sales)
+        order_ids = sales_by_reference.keys()
+
+        batch_size = self.magento_batch_size or \
+            self.default_magento_batch_size()
+
+        sales_orders_data = []
+        with self.get_magento_api(magento.Order) as order_api:
+            for order_ids_batch in batch(order_ids, batch_size):
                 orders_data = order_api.info_multi(order_ids_batch)
 
-            for i, order_data in enumerate(orders_data):
-                if order_data.get('isFault'):
-                    if order_data['faultCode'] == '100':
-                        # 100: Requested order not exists.
-                        # TODO: Remove order from channel or add some
-                        # exception.
-                        pass
-                    logger.warning("Order %s: %s %s" % (
-                        order_ids_batch[i], order_data['faultCode'],
-                        order_data['faultMessage']
-                    ))
-                    continue
-                sale, = Sale.search([
-                    ('reference', '=', order_data['increment_id'])
-                ])
-                sale.update_order_status_from_magento(order_data=order_data)
+                for i, order_data in enumerate(orders_data):
+                    if order_data.get('isFault'):
+                        if order_data['faultCode'] == '100':
+                            # 100: Requested order not exists.
+                            # TODO: Remove order from channel or add some
+                            # exception.
+                            pass
+                        logger.warning("Order %s: %s %s" % (
+                            order_ids_batch[i], order_data['faultCode'],
+                            order_data['faultMessage']
+                        ))
+                        continue
+                    sales_orders_data.append(
+                        (sales_by_reference[order_ids_batch[i]], order_data)
+                    )
+
+        Sale.update_orders_status_from_magento(sales_orders_data)
+
+
+class ChannelOrderState:
+    "Sale Channel Order State"
+    __name__ = 'sale.channel.order_state'
+
+    @classmethod
+    def create(cls, vlist):
+        Channel = Pool().get('sale.channel')
+
+        Channel._magento_tryton_action_cache.clear()
+        return super(ChannelOrderState, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Channel = Pool().get('sale.channel')
+
+        super(ChannelOrderState, cls).write(*args)
+        Channel._magento_tryton_action_cache.clear()
+
+    @classmethod
+    def delete(cls, order_states):
+        Channel = Pool().get('sale.channel')
+
+        super(ChannelOrderState, cls).delete(order_states)
+        Channel._magento_tryton_action_cache.clear()
+
+
+class TaxMapping:
+    "Sale Tax"
+    __name__ = 'sale.channel.tax'
+
+    @classmethod
+    def create(cls, vlist):
+        Channel = Pool().get('sale.channel')
+
+        Channel._magento_tax_cache.clear()
+        return super(TaxMapping, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Channel = Pool().get('sale.channel')
+
+        super(TaxMapping, cls).write(*args)
+        Channel._magento_tax_cache.clear()
+
+    @classmethod
+    def delete(cls, tax_mappings):
+        Channel = Pool().get('sale.channel')
+
+        super(TaxMapping, cls).delete(tax_mappings)
+        Channel._magento_tax_cache.clear()
 
 
 class MagentoTier(ModelSQL, ModelView):
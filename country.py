@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
+from trytond.cache import Cache
 
 
 __all__ = ['Country', 'Subdivision']
@@ -10,6 +11,10 @@ class Country:
     "Country"
     __name__ = 'country.country'
 
+    _magento_code_cache = Cache(
+        'country.country.search_using_magento_code', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -20,28 +25,69 @@ class Country:
             'country_not_found': 'Country with ISO code %s does not exist.',
         })
 
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_code_cache.clear()
+        return super(Country, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(Country, cls).write(*args)
+        cls._magento_code_cache.clear()
+
+    @classmethod
+    def delete(cls, countries):
+        super(Country, cls).delete(countries)
+        cls._magento_code_cache.clear()
+
     @classmethod
     def search_using_magento_code(cls, code):
         """
         Searches for country with given magento code.
 
+        The country found is memoized until countries are modified.
+
         :param code: ISO code of country
         :return: Browse record of country if found else raises error
         """
-        countries = cls.search([('code', '=', code)])
+        country_id = cls._magento_code_cache.get(code)
+        if country_id is None:
+            countries = cls.search([('code', '=', code)])
 
-        if not countries:
-            return cls.raise_user_error(
-                "country_not_found", error_args=(code, )
-            )
+            if not countries:
+                return cls.raise_user_error(
+                    "country_not_found", error_args=(code, )
+                )
 
-        return countries[0]
+            country_id = countries[0].id
+            cls._magento_code_cache.set(code, country_id)
+
+        return cls(country_id)
 
 
 class Subdivision:
     "Subdivision"
     __name__ = 'country.subdivision'
 
+    _magento_region_cache = Cache(
+        'country.subdivision.search_using_magento_region', context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_region_cache.clear()
+        return super(Subdivision, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(Subdivision, cls).write(*args)
+        cls._magento_region_cache.clear()
+
+    @classmethod
+    def delete(cls, subdivisions):
+        super(Subdivision, cls).delete(subdivisions)
+        cls._magento_region_cache.clear()
+
     @classmethod
     def search_using_magento_region(cls, region, country):
         """
@@ -50,15 +96,27 @@ class Subdivision:
         thats why subdivisions here are searched using a case insensitive
         search
 
+        The subdivision found is memoized until subdivisions are modified.
+
         :param region: Name of state from magento
         :param country: Active record of country
         :return: Active record of state if found else raises error
         """
-        subdivisions = cls.search([
-            ('name', 'ilike', region),
-            ('country', '=', country.id),
-        ])
+        key = (region, country.id)
+
+        # A region without subdivision is cached as -1
+        subdivision_id = cls._magento_region_cache.get(key)
+        if subdivision_id is None:
+            subdivisions = cls.search([
+                ('name', 'ilike', region),
+                ('country', '=', country.id),
+            ])
+
+            # TODO: Exception need be created if subdivison does not exist.
 
-        # TODO: Exception need be created if subdivison does not exist.
+            subdivision_id = subdivisions and subdivisions[0].id or -1
+            cls._magento_region_cache.set(key, subdivision_id)
 
-        return subdivisions and subdivisions[0] or None
+        if subdivision_id == -1:
+            return None
+        return cls(subdivision_id)
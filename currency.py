@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
+from trytond.cache import Cache
 
 
 __all__ = ['Currency']
@@ -10,6 +11,10 @@ class Currency:
     "Currency"
     __name__ = 'currency.currency'
 
+    _magento_code_cache = Cache(
+        'currency.currency.search_using_magento_code', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -20,17 +25,41 @@ class Currency:
             'currency_not_found': 'Currency with code %s does not exist.',
         })
 
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_code_cache.clear()
+        return super(Currency, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(Currency, cls).write(*args)
+        cls._magento_code_cache.clear()
+
+    @classmethod
+    def delete(cls, currencies):
+        super(Currency, cls).delete(currencies)
+        cls._magento_code_cache.clear()
+
     @classmethod
     def search_using_magento_code(cls, currency_code):
         """
         Search for currency with given magento currency code.
 
+        The currency found is memoized until currencies are modified.
+
         :param currency_code: currency code given by magento
         :return: Active record of currency if found else raises error
         """
-        currencies = cls.search([('code', '=', currency_code)])
+        currency_id = cls._magento_code_cache.get(currency_code)
+        if currency_id is None:
+            currencies = cls.search([('code', '=', currency_code)])
+
+            if not currencies:
+                return cls.raise_user_error(
+                    'currency_not_found', (currency_code, )
+                )
 
-        if not currencies:
-            return cls.raise_user_error('currency_not_found', (currency_code, ))
+            currency_id = currencies[0].id
+            cls._magento_code_cache.set(currency_code, currency_id)
 
-        return currencies[0]
+        return cls(currency_id)
@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+
 import magento
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 
+from .channel import batch
+
 
 __all__ = ['Party', 'MagentoWebsiteParty', 'Address']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger('magento')
+
+#: Fields of party.address which make its magento fingerprint
+ADDRESS_FINGERPRINT_FIELDS = [
+    'name', 'street', 'zip', 'city', 'country', 'subdivision'
+]
+
 
 class Party:
     "Party"
@@ -44,15 +57,67 @@ class Party:
 
         party = cls.find_using_magento_id(magento_id)
         if not party:
-            with magento.Customer(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as customer_api:
+            with channel.get_magento_api(magento.Customer) as customer_api:
                 customer_data = customer_api.info(magento_id)
 
             party = cls.create_using_magento_data(customer_data)
         return party
 
+    @classmethod
+    def find_or_create_using_magento_ids(cls, magento_ids):
+        """
+        Bulk version of `find_or_create_using_magento_id`.
+
+        Parties already imported are found using a single search and the
+        data of the other customers is fetched from magento using a
+        multiCall for each batch of `magento_batch_size` customers.
+        Customers for which magento returns a fault are logged and skipped.
+
+        :param magento_ids: List of party IDs sent by magento
+        :return: Dictionary of magento ID and active record of party
+        """
+        MagentoParty = Pool().get('sale.channel.magento.party')
+        Channel = Pool().get('sale.channel')
+
+        channel = Channel.get_current_magento_channel()
+
+        magento_ids = set(map(int, filter(None, magento_ids)))
+        if not magento_ids:
+            return {}
+
+        parties = dict(
+            (magento_party.magento_id, magento_party.party)
+            for magento_party in MagentoParty.search([
+                ('magento_id', 'in', list(magento_ids)),
+                ('channel', '=', channel.id),
+            ])
+        )
+
+        missing_ids = sorted(magento_ids - set(parties))
+        batch_size = channel.magento_batch_size or \
+            channel.default_magento_batch_size()
+        for missing_ids_batch in batch(missing_ids, batch_size):
+            with channel.get_magento_api(magento.Customer) as customer_api:
+                customers_data = customer_api.multiCall([
+                    ['customer.info', [magento_id]]
+                    for magento_id in missing_ids_batch
+                ])
+
+            for magento_id, customer_data in zip(
+                missing_ids_batch, customers_data
+            ):
+                if customer_data.get('isFault'):
+                    logger.warning("Customer %s: %s %s" % (
+                        magento_id, customer_data['faultCode'],
+                        customer_data['faultMessage']
+                    ))
+                    continue
+                parties[magento_id] = cls.create_using_magento_data(
+                    customer_data
+                )
+
+        return parties
+
     @classmethod
     def find_using_magento_id(cls, magento_id):
         """
@@ -151,9 +216,9 @@ class MagentoWebsiteParty(ModelSQL, ModelView):
     "Magento Website Party"
     __name__ = 'sale.channel.magento.party'
 
-    magento_id = fields.Integer('Magento ID', readonly=True)
+    magento_id = fields.Integer('Magento ID', readonly=True, select=True)
     channel = fields.Many2One(
-        'sale.channel', 'Channel', required=True, readonly=True
+        'sale.channel', 'Channel', required=True, readonly=True, select=True
     )
     party = fields.Many2One(
         'party.party', 'Party', required=True, readonly=True
@@ -195,25 +260,67 @@ class Address:
     "Address"
     __name__ = 'party.address'
 
-    def match_with_magento_data(self, address_data):
+    #: Digest of the fields compared when matching the address with magento
+    #: address data, maintained on create and write.
+    magento_fingerprint = fields.Char(
+        'Magento Fingerprint', readonly=True, select=True
+    )
+
+    @staticmethod
+    def get_magento_fingerprint(values):
         """
-        Match the current address with the address_record.
-        Match all the fields of the address, i.e., streets, city, subdivision
-        and country. For any deviation in any field, returns False.
+        Returns the fingerprint of the address with given values. Addresses
+        whose name, street, zip, city, country and subdivision are all the
+        same have the same fingerprint.
+
+        :param values: Dictionary of the address fields, with the IDs of the
+                       country and subdivision
+        :return: Hexadecimal digest of the address
+        """
+        return hashlib.sha1(json.dumps([
+            values.get(field) or None for field in ADDRESS_FINGERPRINT_FIELDS
+        ])).hexdigest()
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [values.copy() for values in vlist]
+        for values in vlist:
+            values['magento_fingerprint'] = cls.get_magento_fingerprint(values)
+        return super(Address, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+
+        addresses = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if set(values) & set(ADDRESS_FINGERPRINT_FIELDS):
+                addresses.extend(records)
+        if not addresses:
+            return
+
+        write_args = []
+        for values in cls.read(
+                map(int, addresses), ADDRESS_FINGERPRINT_FIELDS):
+            write_args.extend([[cls(values['id'])], {
+                'magento_fingerprint': cls.get_magento_fingerprint(values),
+            }])
+        super(Address, cls).write(*write_args)
+
+    @classmethod
+    def get_magento_address_values(cls, address_data):
+        """
+        Returns the values of the address fields for the given magento
+        address data. The country and subdivision are resolved here once.
 
         :param address_data: Dictionary of address data from magento
-        :return: True if address matches else False
+        :return: Dictionary of the address fields, with the IDs of the
+                 country and subdivision
         """
         Country = Pool().get('country.country')
         Subdivision = Pool().get('country.subdivision')
 
-        # Check if the name matches
-        if self.name != ' '.join(
-            filter(None, [address_data['firstname'], address_data['lastname']])
-        ):
-            return False
-
-        # Find country and subdivision based on magento data
         country = None
         subdivision = None
         if address_data['country_id']:
@@ -225,12 +332,36 @@ class Address:
                     address_data['region'], country
                 )
 
+        return {
+            'name': ' '.join(filter(
+                None, [address_data['firstname'], address_data['lastname']]
+            )),
+            'street': address_data['street'],
+            'zip': address_data['postcode'],
+            'city': address_data['city'],
+            'country': country and country.id or None,
+            'subdivision': subdivision and subdivision.id or None,
+        }
+
+    def match_with_magento_data(self, address_data):
+        """
+        Match the current address with the address_record.
+        Match all the fields of the address, i.e., streets, city, subdivision
+        and country. For any deviation in any field, returns False.
+
+        :param address_data: Dictionary of address data from magento
+        :return: True if address matches else False
+        """
+        values = self.get_magento_address_values(address_data)
+
         if not all([
-            self.street == (address_data['street'] or None),
-            self.zip == (address_data['postcode'] or None),
-            self.city == (address_data['city'] or None),
-            self.country == country,
-            self.subdivision == subdivision,
+            self.name == values['name'],
+            self.street == (values['street'] or None),
+            self.zip == (values['zip'] or None),
+            self.city == (values['city'] or None),
+            (self.country and self.country.id) == values['country'],
+            (self.subdivision and self.subdivision.id) ==
+            values['subdivision'],
         ]):
             return False
 
@@ -242,57 +373,70 @@ class Address:
         Look for the address in tryton corresponding to the address_record.
         If found, return the same else create a new one and return that.
 
+        The address is looked up by its fingerprint. Addresses created
+        before fingerprints were maintained are matched field by field and
+        get their fingerprint on the way.
+
         :param party: Party active record
         :param address_data: Dictionary of address data from magento
         :return: Active record of address created/found
         """
-        for address in party.addresses:
-            if address.match_with_magento_data(address_data):
-                break
+        values = cls.get_magento_address_values(address_data)
+        fingerprint = cls.get_magento_fingerprint(values)
 
-        else:
-            address = cls.create_for_party_using_magento_data(
-                party, address_data
-            )
+        addresses = cls.search([
+            ('party', '=', party.id),
+            ('magento_fingerprint', '=', fingerprint),
+        ], limit=1)
+        if addresses:
+            return addresses[0]
 
-        return address
+        legacy_addresses = cls.search([
+            ('party', '=', party.id),
+            ('magento_fingerprint', '=', None),
+        ])
+        if legacy_addresses:
+            write_args = []
+            match = None
+            for address_values in cls.read(
+                    map(int, legacy_addresses), ADDRESS_FINGERPRINT_FIELDS):
+                address_fingerprint = cls.get_magento_fingerprint(
+                    address_values
+                )
+                address = cls(address_values['id'])
+                if match is None and address_fingerprint == fingerprint:
+                    match = address
+                write_args.extend([[address], {
+                    'magento_fingerprint': address_fingerprint,
+                }])
+            super(Address, cls).write(*write_args)
+            if match is not None:
+                return match
+
+        return cls.create_for_party_using_magento_data(
+            party, address_data, values
+        )
 
     @classmethod
-    def create_for_party_using_magento_data(cls, party, address_data):
+    def create_for_party_using_magento_data(
+        cls, party, address_data, values=None
+    ):
         """
         Create address from the address record given and link it to the
         party.
 
         :param party: Party active record
         :param address_data: Dictionary of address data from magento
+        :param values: Values of the address fields for the address data, if
+                       they are already known
         :return: Active record of created address
         """
-        Country = Pool().get('country.country')
-        Subdivision = Pool().get('country.subdivision')
         ContactMechanism = Pool().get('party.contact_mechanism')
 
-        country = None
-        subdivision = None
-        if address_data['country_id']:
-            country = Country.search_using_magento_code(
-                address_data['country_id']
-            )
-            if address_data['region']:
-                subdivision = Subdivision.search_using_magento_region(
-                    address_data['region'], country
-                )
+        if values is None:
+            values = cls.get_magento_address_values(address_data)
 
-        address, = cls.create([{
-            'party': party.id,
-            'name': ' '.join(filter(
-                None, [address_data['firstname'], address_data['lastname']]
-            )),
-            'street': address_data['street'],
-            'zip': address_data['postcode'],
-            'city': address_data['city'],
-            'country': country and country.id or None,
-            'subdivision': subdivision and subdivision.id or None,
-        }])
+        address, = cls.create([dict(values, party=party.id)])
 
         # Create phone as contact mechanism
         if address_data.get('telephone') and not ContactMechanism.search([
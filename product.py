@@ -1,6 +1,12 @@
 # -*- coding: UTF-8 -*-
 import magento
+import socket
+import threading
+import time
+import urlparse
+import xmlrpclib
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 import logbook
 from trytond.model import ModelSQL, ModelView, fields
@@ -19,11 +25,31 @@ __metaclass__ = PoolMeta
 
 log = logbook.Logger('magento', logbook.INFO)
 
+#: Upper bound of the adaptive inventory batch size
+MAX_INVENTORY_BATCH_SIZE = 1000
 
-def batch(iterable, n=1):
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
+#: Number of channels whose inventory is pushed at the same time
+INVENTORY_CHANNEL_WORKERS = 4
+
+#: Number of concurrent inventory requests sent to a single magento host
+INVENTORY_REQUESTS_PER_HOST = 2
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def get_host_semaphore(url):
+    """
+    Returns the semaphore bounding the concurrent inventory requests sent
+    to the magento host of the given URL
+    """
+    host = urlparse.urlparse(url).netloc or url
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                INVENTORY_REQUESTS_PER_HOST
+            )
+        return _host_semaphores[host]
 
 
 class Category:
@@ -91,10 +117,7 @@ class Category:
         if not category:
             channel = Channel.get_current_magento_channel()
 
-            with magento.Category(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as category_api:
+            with channel.get_magento_api(magento.Category) as category_api:
                 category_data = category_api.info(magento_id)
 
             category = cls.create_using_magento_data(
@@ -214,14 +237,17 @@ class ProductSaleChannelListing:
             "invisible": Eval('channel_source') != 'magento'
         }, depends=['channel_source']
     )
-
-    @classmethod
-    def __setup__(cls):
-        super(ProductSaleChannelListing, cls).__setup__()
-        cls._error_messages.update({
-            'multi_inventory_update_fail':
-            "FaultCode: %s, FaultMessage: %s",
-        })
+    #: Digest of the tier prices last exported to magento for this listing
+    magento_tier_price_digest = fields.Char(
+        'Magento Tier Price Digest', readonly=True
+    )
+    #: Quantity and stock status last exported to magento for this listing
+    magento_exported_quantity = fields.Float(
+        'Magento Exported Quantity', readonly=True
+    )
+    magento_exported_in_stock = fields.Boolean(
+        'Magento Exported In Stock', readonly=True
+    )
 
     @classmethod
     def create_from(cls, channel, product_data):
@@ -253,95 +279,407 @@ class ProductSaleChannelListing:
         listing.save()
         return listing
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for listings, values in zip(actions, actions):
+            if 'product_identifier' in values or 'state' in values:
+                # The inventory exported earlier may not be the one magento
+                # has for the listing any more
+                values = values.copy()
+                values.update({
+                    'magento_exported_quantity': None,
+                    'magento_exported_in_stock': None,
+                })
+            args.extend((listings, values))
+        super(ProductSaleChannelListing, cls).write(*args)
+
     def export_inventory(self):
         """
         Export inventory of this listing
+
+        The inventory is sent even if it did not change since the last
+        export, so that magento can be resynchronized with it.
         """
         if self.channel.source != 'magento':
             return super(ProductSaleChannelListing, self).export_inventory()
 
-        return self.export_bulk_inventory([self])
+        with Transaction().set_context(magento_force_inventory_export=True):
+            return self.export_bulk_inventory([self])
 
     @classmethod
     def export_bulk_inventory(cls, listings):
         """
         Bulk export inventory to magento.
 
+        The quantity and stock status exported are stored on each listing,
+        and only the listings whose inventory changed since the last export
+        are sent to magento, unless `magento_force_inventory_export` is set
+        in the context.
+
+        Products which do not exist on magento (fault 101) are disabled.
+        Other faults, and errors which stop the push of a channel, do not
+        stop the export, they are logged together once all the inventory is
+        pushed.
+
         Do not rely on the return value from this method.
         """
-        SaleChannelListing = Pool().get('product.product.channel_listing')
-
         if not listings:
             # Nothing to update
             return
 
-        non_magento_listings = cls.search([
-            ('id', 'in', map(int, listings)),
-            ('channel.source', '!=', 'magento'),
+        Channel = Pool().get('sale.channel')
+
+        force = Transaction().context.get('magento_force_inventory_export')
+
+        listings_data = cls.read(map(int, listings), [
+            'channel', 'product', 'product_identifier',
+            'magento_product_type', 'magento_exported_quantity',
+            'magento_exported_in_stock',
+        ])
+        magento_channel_ids = set(
+            channel['id'] for channel in Channel.read(
+                list(set(data['channel'] for data in listings_data)),
+                ['source']
+            ) if channel['source'] == 'magento'
+        )
+
+        non_magento_listings = cls.browse([
+            data['id'] for data in listings_data
+            if data['channel'] not in magento_channel_ids
         ])
         if non_magento_listings:
             super(ProductSaleChannelListing, cls).export_bulk_inventory(
                 non_magento_listings
             )
-        magento_listings = filter(
-            lambda l: l not in non_magento_listings, listings
-        )
+        magento_listings_data = [
+            data for data in listings_data
+            if data['channel'] in magento_channel_ids
+        ]
 
         log.info(
             "Fetching inventory of %d magento listings"
-            % len(magento_listings)
+            % len(magento_listings_data)
+        )
+
+        quantities = cls.get_magento_listing_quantities(
+            cls.browse([data['id'] for data in magento_listings_data])
         )
 
         inventory_channel_map = defaultdict(list)
-        for listing in magento_listings:
-            channel = listing.channel
-
-            product_data = {
-                'qty': listing.quantity,
-            }
-
-            # TODO: Get this from availability used
-            if listing.magento_product_type == 'simple':
-                # Only send inventory for simple products
-                product_data['is_in_stock'] = '1' \
-                    if listing.quantity > 0 else '0'
-            else:
-                # configurable, bundle and everything else
-                product_data['is_in_stock'] = '1'
+        for listing in magento_listings_data:
+            listing['quantity'] = quantities[listing['id']]
+            product_data = cls.get_magento_inventory_data(listing)
+
+            # Only send the inventory which changed since the last export
+            unchanged = \
+                listing['magento_exported_quantity'] == product_data['qty'] \
+                and listing['magento_exported_in_stock'] == \
+                (product_data['is_in_stock'] == '1')
+            if unchanged and not force:
+                continue
 
             # group inventory xml by channel
-            inventory_channel_map[channel].append([
-                listing.product_identifier, product_data
-            ])
+            inventory_channel_map[Channel(listing['channel'])].append(
+                (listing, product_data)
+            )
+
+        log.info(
+            "Inventory of %d magento listings changed since the last export"
+            % sum(map(len, inventory_channel_map.values()))
+        )
+
+        # The inventory is pushed to magento by one thread per channel. The
+        # threads only talk to magento, everything they need from the
+        # database is read here and the responses are processed here.
+        pushes = []
+        for channel, listing_data_list in inventory_channel_map.iteritems():
+            pushes.append((
+                channel.get_magento_api(magento.Inventory),
+                get_host_semaphore(channel.magento_url),
+                [
+                    [listing_data['product_identifier'], inventory_data]
+                    for listing_data, inventory_data in listing_data_list
+                ], {
+                    'batch_size': channel.magento_inventory_batch_size or
+                    channel.default_magento_inventory_batch_size(),
+                    'adaptive': channel.magento_inventory_adaptive_batch,
+                    'target_latency':
+                    channel.magento_inventory_target_latency or
+                    channel.default_magento_inventory_target_latency(),
+                }
+            ))
+
+        def push_channel_inventory(push):
+            inventory_api_context, semaphore, inventory, settings = push
+            responses = []
+            try:
+                with inventory_api_context as inventory_api:
+                    for response in cls.push_inventory_to_magento(
+                        inventory_api, inventory, semaphore=semaphore,
+                        **settings
+                    ):
+                        responses.append(response)
+            except (
+                xmlrpclib.Fault, xmlrpclib.ProtocolError, IOError,
+                socket.timeout
+            ), exc:
+                # Keep the responses of the batches pushed before the error,
+                # the other channels are not affected
+                return responses, exc
+            return responses, None
+
+        if len(pushes) > 1:
+            pool = ThreadPool(min(len(pushes), INVENTORY_CHANNEL_WORKERS))
+            try:
+                channel_responses = pool.map(push_channel_inventory, pushes)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            channel_responses = map(push_channel_inventory, pushes)
+
+        exported_inventory = defaultdict(list)
+        failures = []
+        for (channel, listing_data_list), (responses, error) in zip(
+                inventory_channel_map.iteritems(), channel_responses):
+            channel_exported, channel_failures = \
+                cls.process_magento_inventory_responses(
+                    channel, listing_data_list, responses, error
+                )
+            for key, listing_ids in channel_exported.iteritems():
+                exported_inventory[key].extend(listing_ids)
+            failures.extend(channel_failures)
+
+        cls.set_magento_exported_inventory(exported_inventory)
+
+        if failures:
+            log.error(
+                "Inventory of %d products could not be exported:\n%s" % (
+                    len(failures), '\n'.join([
+                        "%s (%s): %s %s" % (
+                            product_identifier, channel.rec_name,
+                            fault_code, fault_message
+                        ) for channel, product_identifier, fault_code,
+                        fault_message in failures
+                    ])
+                )
+            )
+
+    @classmethod
+    def get_magento_inventory_data(cls, listing_data):
+        """
+        Returns the inventory data sent to magento for a listing
+
+        :param listing_data: Dictionary with the `quantity` and the
+                             `magento_product_type` of the listing
+        :return: Dictionary of inventory data
+        """
+        product_data = {
+            'qty': listing_data['quantity'],
+        }
+
+        # TODO: Get this from availability used
+        if listing_data['magento_product_type'] == 'simple':
+            # Only send inventory for simple products
+            product_data['is_in_stock'] = '1' \
+                if listing_data['quantity'] > 0 else '0'
+        else:
+            # configurable, bundle and everything else
+            product_data['is_in_stock'] = '1'
+        return product_data
+
+    @classmethod
+    def process_magento_inventory_responses(
+        cls, channel, listing_data_list, responses, error=None
+    ):
+        """
+        Process the responses of magento to the inventory pushed for a
+        channel. The listings whose product does not exist on magento are
+        disabled with a single write.
+
+        :param channel: Active record of the channel
+        :param listing_data_list: List of tuples of listing data and the
+                                  inventory data pushed for it
+        :param responses: List of tuples (position of the batch in the
+                          inventory, response)
+        :param error: Exception which stopped the push before all the
+                      inventory was answered
+        :return: Tuple of dictionary of (quantity, in stock) to the IDs of
+                 the exported listings and list of failures (channel,
+                 product identifier, fault code, fault message)
+        """
+        exported_inventory = defaultdict(list)
+        failures = []
+        missing_identifiers = []
+        answered = 0
+        for position, response in responses:
+            # Magento bulk API will not raise Faults.
+            # Instead the response contains the faults as a dict
+            for i, result in enumerate(response):
+                listing, product_data = listing_data_list[position + i]
+                if result is True:
+                    exported_inventory[(
+                        product_data['qty'],
+                        product_data['is_in_stock'] == '1',
+                    )].append(listing['id'])
+                elif result.get('isFault') is True and \
+                        result['faultCode'] == '101':
+                    # The product does not exist on magento
+                    missing_identifiers.append(listing['product_identifier'])
+                else:
+                    failures.append((
+                        channel, listing['product_identifier'],
+                        result['faultCode'], result['faultMessage']
+                    ))
+            answered = position + len(response)
+
+        if error is not None:
+            if isinstance(error, xmlrpclib.Fault):
+                fault_code, fault_message = error.faultCode, error.faultString
+            else:
+                fault_code, fault_message = error.__class__.__name__, error
+            for listing, _ in listing_data_list[answered:]:
+                failures.append((
+                    channel, listing['product_identifier'], fault_code,
+                    fault_message
+                ))
+
+        if missing_identifiers:
+            cls.write(cls.search([
+                ('product_identifier', 'in', missing_identifiers),
+                ('channel', '=', channel.id),
+            ]), {'state': 'disabled'})
+
+        return exported_inventory, failures
 
-        for channel, product_data_list in inventory_channel_map.iteritems():
-            with magento.Inventory(
-                    channel.magento_url,
-                    channel.magento_api_user,
-                    channel.magento_api_key) as inventory_api:
-                for product_data_batch in batch(product_data_list, 50):
-                    log.info(
-                        "Pushing inventory of %d products to magento"
-                        % len(product_data_batch)
+    @classmethod
+    def set_magento_exported_inventory(cls, exported_inventory):
+        """
+        Remember the inventory exported to magento for the listings, with a
+        single write
+
+        :param exported_inventory: Dictionary of (quantity, in stock) to the
+                                   IDs of the exported listings
+        """
+        if not exported_inventory:
+            return
+
+        write_args = []
+        for (quantity, in_stock), listing_ids in \
+                exported_inventory.iteritems():
+            write_args.extend([cls.browse(listing_ids), {
+                'magento_exported_quantity': quantity,
+                'magento_exported_in_stock': in_stock,
+            }])
+        cls.write(*write_args)
+
+    @classmethod
+    def get_magento_listing_quantities(cls, listings):
+        """
+        Compute the quantities of the products of the given listings in
+        bulk. The listings are grouped by the context their availability is
+        computed with (see `get_availability_context`), and the quantities
+        of each group are computed with a single stock computation.
+
+        :param listings: List of active records of listings
+        :return: Dictionary of listing ID to quantity
+        """
+        Product = Pool().get('product.product')
+
+        contexts = {}
+        context_listings = defaultdict(list)
+        for listing in listings:
+            context = listing.get_availability_context()
+            key = tuple(sorted(
+                (name, tuple(value) if isinstance(value, list) else value)
+                for name, value in context.iteritems()
+            ))
+            contexts[key] = context
+            context_listings[key].append(listing)
+
+        quantities = {}
+        for key, listings_group in context_listings.iteritems():
+            product_ids = list(set(
+                listing.product.id for listing in listings_group
+            ))
+            with Transaction().set_context(**contexts[key]):
+                product_quantities = Product.get_quantity(
+                    Product.browse(product_ids), 'quantity'
+                )
+            for listing in listings_group:
+                quantities[listing.id] = product_quantities[listing.product.id]
+        return quantities
+
+    @classmethod
+    def push_inventory_to_magento(
+        cls, inventory_api, inventory, batch_size, adaptive=False,
+        target_latency=None, semaphore=None
+    ):
+        """
+        Generator which pushes the given inventory to magento in batches of
+        `batch_size` products.
+
+        With an adaptive batch size, the batch size is doubled after every
+        batch which magento answers within the target latency, and halved
+        after a batch which is slower or has faults. A batch which times out
+        or fails as a whole is retried with half the size.
+
+        This does not access the database, so that it can be run in a
+        separate thread.
+
+        :param inventory_api: Magento inventory API
+        :param inventory: List of [product identifier, inventory data]
+        :param batch_size: Number of products pushed in a single request
+        :param adaptive: Whether the batch size adapts to the response time
+        :param target_latency: Seconds within which magento is expected to
+                               respond to a batch
+        :param semaphore: Semaphore bounding the concurrent requests to the
+                          magento host
+        :return: Generator of tuples (position of the batch in the
+                 inventory, response)
+        """
+        position = 0
+        while position < len(inventory):
+            inventory_batch = inventory[position:position + batch_size]
+            log.info(
+                "Pushing inventory of %d products to magento"
+                % len(inventory_batch)
+            )
+            try:
+                if semaphore is not None:
+                    semaphore.acquire()
+                try:
+                    started = time.time()
+                    response = inventory_api.update_multi(inventory_batch)
+                finally:
+                    if semaphore is not None:
+                        semaphore.release()
+            except (
+                xmlrpclib.Fault, xmlrpclib.ProtocolError, IOError,
+                socket.timeout
+            ):
+                if not adaptive or batch_size == 1:
+                    raise
+                batch_size = max(batch_size // 2, 1)
+                log.warning(
+                    "Inventory push failed, retrying with batches of %d "
+                    "products" % batch_size
+                )
+                continue
+
+            yield position, response
+            position += len(inventory_batch)
+
+            if adaptive:
+                if time.time() - started > target_latency or \
+                        any(result is not True for result in response):
+                    batch_size = max(batch_size // 2, 1)
+                else:
+                    batch_size = min(
+                        batch_size * 2, MAX_INVENTORY_BATCH_SIZE
                     )
-                    response = inventory_api.update_multi(product_data_batch)
-                    # Magento bulk API will not raise Faults.
-                    # Instead the response contains the faults as a dict
-                    for i, result in enumerate(response):
-                        if result is not True:
-                            if result.get('isFault') is True and \
-                                    result['faultCode'] == '101':
-                                listing, = SaleChannelListing.search([
-                                    ('product_identifier', '=', product_data_batch[i][0]),  # noqa
-                                    ('channel', '=', channel.id),
-                                ])
-                                listing.state = 'disabled'
-                                listing.save()
-                            else:
-                                cls.raise_user_error(
-                                    'multi_inventory_update_fail',
-                                    (result['faultCode'], result['faultMessage'])  # noqa
-                                )
 
 
 class Product:
@@ -490,10 +828,7 @@ class Product:
 
         channel = Channel.get_current_magento_channel()
 
-        with magento.Product(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as product_api:
+        with channel.get_magento_api(magento.Product) as product_api:
             channel_listing, = SaleChannelListing.search([
                 ('product', '=', self.id),
                 ('channel', '=', channel.id),
@@ -50,17 +50,25 @@ class Sale:
         })
 
     @classmethod
-    def find_or_create_using_magento_data(cls, order_data):
+    def find_or_create_using_magento_data(
+        cls, order_data, party_ids=None, product_ids=None
+    ):
         """
         Find or Create sale using magento data
 
         :param order_data: Order Data from magento
+        :param party_ids: Dictionary of magento customer ID and ID of the
+                          party, for the customers resolved beforehand
+        :param product_ids: Dictionary of SKU and ID of the product, for the
+                            products resolved beforehand
         :return: Active record of record created/found
         """
         sale = cls.find_using_magento_data(order_data)
 
         if not sale:
-            sale = cls.create_using_magento_data(order_data)
+            sale = cls.create_using_magento_data(
+                order_data, party_ids=party_ids, product_ids=product_ids
+            )
 
         return sale
 
@@ -82,9 +90,13 @@ class Sale:
         return sales and sales[0] or None
 
     @classmethod
-    def get_sale_using_magento_data(cls, order_data):
+    def get_sale_using_magento_data(cls, order_data, party_ids=None):
         """
         Return an active record of the sale from magento data
+
+        :param order_data: Order Data from magento
+        :param party_ids: Dictionary of magento customer ID and ID of the
+                          party, for the customers resolved beforehand
         """
         Sale = Pool().get('sale.sale')
         Party = Pool().get('party.party')
@@ -98,7 +110,10 @@ class Sale:
             order_data['order_currency_code']
         )
 
-        if order_data['customer_id']:
+        if order_data['customer_id'] and party_ids and \
+                int(order_data['customer_id']) in party_ids:
+            party = Party(party_ids[int(order_data['customer_id'])])
+        elif order_data['customer_id']:
             party = Party.find_or_create_using_magento_id(
                 order_data['customer_id']
             )
@@ -173,13 +188,19 @@ class Sale:
         })
 
     @classmethod
-    def create_using_magento_data(cls, order_data):
+    def create_using_magento_data(
+        cls, order_data, party_ids=None, product_ids=None
+    ):
         """
         Create a sale from magento data. If you wish to override the creation
         process, it is recommended to subclass and manipulate the returned
         unsaved active record from the `get_sale_using_magento_data` method.
 
         :param order_data: Order data from magento
+        :param party_ids: Dictionary of magento customer ID and ID of the
+                          party, for the customers resolved beforehand
+        :param product_ids: Dictionary of SKU and ID of the product, for the
+                            products resolved beforehand
         :return: Active record of record created
         """
         ChannelException = Pool().get('channel.exception')
@@ -194,17 +215,20 @@ class Sale:
         if state_data['action'] == 'do_not_import':
             return
 
-        sale = cls.get_sale_using_magento_data(order_data)
+        sale = cls.get_sale_using_magento_data(
+            order_data, party_ids=party_ids
+        )
         sale.save()
 
         sale.lines = list(sale.lines)
-        sale.add_lines_using_magento_data(order_data)
+        sale.add_lines_using_magento_data(
+            order_data, product_ids=product_ids
+        )
         sale.save()
 
         sale.create_payment_using_magento_data(order_data['payment'])
 
         # Process sale now
-        tryton_action = channel.get_tryton_action(order_data['state'])
         try:
             sale.process_to_channel_state(order_data['state'])
         except UserError, e:
@@ -215,7 +239,7 @@ class Sale:
             ChannelException.create([{
                 'origin': '%s,%s' % (sale.__name__, sale.id),
                 'log': "Error occurred on transitioning to state %s.\nError "
-                    "Message: %s" % (tryton_action['action'], e.message),
+                    "Message: %s" % (state_data['action'], e.message),
                 'channel': sale.channel.id,
             }])
 
@@ -255,13 +279,15 @@ class Sale:
             for transaction in payment.payment_transactions:
                 transaction.safe_post()
 
-    def add_lines_using_magento_data(self, order_data):
+    def add_lines_using_magento_data(self, order_data, product_ids=None):
         """
         Create sale lines from the magento data and associate them with
         the current sale.
         This method decides the actions to be taken on different product types
 
         :param order_data: Order Data from magento
+        :param product_ids: Dictionary of SKU and ID of the product, for the
+                            products resolved beforehand
         """
         Bom = Pool().get('production.bom')
 
@@ -274,7 +300,9 @@ class Sale:
                     item['parent_item_id']:
                 continue
 
-            sale_line = self.get_sale_line_using_magento_data(item)
+            sale_line = self.get_sale_line_using_magento_data(
+                item, product_ids=product_ids
+            )
             if sale_line is not None:
                 self.lines.append(sale_line)
 
@@ -293,10 +321,15 @@ class Sale:
                 self.get_discount_line_data_using_magento_data(order_data)
             )
 
-    def get_sale_line_using_magento_data(self, item):
+    def get_sale_line_using_magento_data(self, item, product_ids=None):
         """
         Get sale.line data from magento data.
+
+        :param item: Item data from magento
+        :param product_ids: Dictionary of SKU and ID of the product, for the
+                            products resolved beforehand
         """
+        Product = Pool().get('product.product')
         SaleLine = Pool().get('sale.line')
         ChannelException = Pool().get('channel.exception')
         Channel = Pool().get('sale.channel')
@@ -306,8 +339,12 @@ class Sale:
         sale_line = None
         if not item['parent_item_id']:
             # If its a top level product, create it
+            sku = (item['sku'] or '').strip()
             try:
-                product = channel.get_product(item['sku'])
+                if product_ids and sku in product_ids:
+                    product = Product(product_ids[sku])
+                else:
+                    product = channel.get_product(item['sku'])
             except xmlrpclib.Fault, exception:
                 if exception.faultCode == 101:
                     # Case when product doesnot exist on magento
@@ -332,9 +369,8 @@ class Sale:
                 'product': product,
             })
             if item.get('tax_percent') and Decimal(item.get('tax_percent')):
-                taxes = [channel.get_tax(
-                    name=None,
-                    rate=Decimal(item['tax_percent']) / 100
+                taxes = [channel.get_magento_tax(
+                    Decimal(item['tax_percent']) / 100
                 )]
                 sale_line.taxes = taxes
         return sale_line
@@ -358,10 +394,7 @@ class Sale:
         sale = cls.find_using_magento_increment_id(order_increment_id)
 
         if not sale:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.get_magento_api(magento.Order) as order_api:
                 order_data = order_api.info(order_increment_id)
 
             sale = cls.create_using_magento_data(order_data)
@@ -386,6 +419,27 @@ class Sale:
         ])
         return sales and sales[0] or None
 
+    @classmethod
+    def find_using_magento_ids(cls, order_ids):
+        """
+        Bulk version of `find_using_magento_id`. All the sales are searched
+        in one query (per `IN_MAX` IDs).
+
+        :param order_ids: List of order IDs from magento
+        :returns: Dictionary of magento ID and active record of sale
+        """
+        in_max = Transaction().cursor.IN_MAX
+
+        sales = {}
+        order_ids = list(set(map(int, order_ids)))
+        for ndx in range(0, len(order_ids), in_max):
+            for sale in cls.search([
+                ('magento_id', 'in', order_ids[ndx:ndx + in_max]),
+                ('channel', '=', Transaction().context['current_channel'])
+            ]):
+                sales[sale.magento_id] = sale
+        return sales
+
     @classmethod
     def find_using_magento_increment_id(cls, order_increment_id):
         """
@@ -505,10 +559,7 @@ class Sale:
         # order status change due to its workflow constraints.
         # TODO: Find a better way to do it
         try:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.get_magento_api(magento.Order) as order_api:
                 if self.state == 'cancel':
                     order_api.cancel(increment_id)
                 elif self.state == 'done':
@@ -534,31 +585,50 @@ class Sale:
         :TODO: this only handles complete orders of magento. Should handle
         other states too?
         """
-        Shipment = Pool().get('stock.shipment.out')
-
         if order_data is None:
             # XXX: Magento order_data is already there, so need not to
             # fetch again
-            with magento.Order(
-                self.channel.magento_url, self.channel.magento_api_user,
-                self.channel.magento_api_key
-            ) as order_api:
+            with self.channel.get_magento_api(magento.Order) as order_api:
                 order_data = order_api.info(self.reference)
 
-        if order_data['status'] == 'complete':
-            # Order is completed on magento, process shipments and
-            # invoices.
-            for shipment in self.shipments:
-                if shipment.state == 'draft':
-                    Shipment.wait([shipment])
-                if shipment.state == 'waiting':
-                    Shipment.assign([shipment])
-                if shipment.state == 'assigned':
-                    Shipment.pack([shipment])
-                if shipment.state == 'packed':
-                    Shipment.done([shipment])
+        self.update_orders_status_from_magento([(self, order_data)])
+
+    @classmethod
+    def update_orders_status_from_magento(cls, sales_orders_data):
+        """Update status of many orders from magento at once.
+
+        The shipments of all the orders which are complete on magento are
+        grouped by their state, and each group is moved through the
+        workflow with one call per transition.
+
+        :param sales_orders_data: List of tuples (sale, order data from
+                                  magento)
+        """
+        Shipment = Pool().get('stock.shipment.out')
 
-            # TODO: handle invoices?
+        # Orders completed on magento, process their shipments.
+        shipments = [
+            shipment for sale, order_data in sales_orders_data
+            if order_data['status'] == 'complete'
+            for shipment in sale.shipments
+        ]
+        for state, transition in [
+            ('draft', Shipment.wait),
+            ('waiting', Shipment.assign),
+            ('assigned', Shipment.pack),
+            ('packed', Shipment.done),
+        ]:
+            # Read the states again, as each transition moves the shipments
+            # to the next state
+            shipments = Shipment.browse(map(int, shipments))
+            shipments_in_state = [
+                shipment for shipment in shipments
+                if shipment.state == state
+            ]
+            if shipments_in_state:
+                transition(shipments_in_state)
+
+        # TODO: handle invoices?
 
 
 class SaleLine:
@@ -621,10 +691,7 @@ class StockShipmentOut:
             code, title = carrier.get_magento_mapping()
 
         # Add tracking info to the shipment on magento
-        with magento.Shipment(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as shipment_api:
+        with channel.get_magento_api(magento.Shipment) as shipment_api:
             shipment_increment_id = shipment_api.addtrack(
                 self.magento_increment_id, code, title, self.tracking_number
             )
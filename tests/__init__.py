@@ -8,6 +8,7 @@ from tests.test_party import TestParty
 from tests.test_product import TestProduct
 from tests.test_sale import TestSale
 from tests.test_currency import TestCurrency
+from tests.test_api import TestSessionPool
 
 
 def suite():
@@ -22,6 +23,7 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestSale),
         unittest.TestLoader().loadTestsFromTestCase(TestCurrency),
+        unittest.TestLoader().loadTestsFromTestCase(TestSessionPool),
     ])
     return test_suite
 
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import sys
+import os
+import unittest
+import xmlrpclib
+
+import magento
+from mock import MagicMock
+from trytond.modules.magento.api import SessionPool, TimeoutTransport, \
+    SafeTimeoutTransport
+
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+
+def mock_order_api():
+    mock = MagicMock(spec=magento.Order)
+    handle = MagicMock(spec=magento.Order)
+    handle.__enter__.return_value = handle
+    mock.return_value = handle
+    return mock
+
+
+class TestSessionPool(unittest.TestCase):
+    """
+    Tests the pool of magento sessions
+    """
+
+    def test_0010_session_is_reused(self):
+        """
+        Tests that the login is done only once for consecutive calls
+        """
+        pool = SessionPool()
+        order_api = mock_order_api()
+
+        for i in range(3):
+            with pool.resource(order_api, 'url', 'user', 'key'):
+                pass
+
+        self.assertEqual(order_api.return_value.__enter__.call_count, 1)
+
+        # Different credentials get their own session
+        with pool.resource(order_api, 'url', 'other user', 'key'):
+            pass
+        self.assertEqual(order_api.return_value.__enter__.call_count, 2)
+
+    def test_0020_login_again_when_session_expires(self):
+        """
+        Tests that the call is retried after login if the session expired
+        """
+        pool = SessionPool()
+        order_api = mock_order_api()
+        order_api.return_value.info.side_effect = [
+            xmlrpclib.Fault(5, 'Session expired. Try to relogin.'),
+            {'increment_id': '100000001'},
+        ]
+
+        with pool.resource(order_api, 'url', 'user', 'key') as api:
+            self.assertEqual(
+                api.info('100000001'), {'increment_id': '100000001'}
+            )
+
+        self.assertEqual(order_api.return_value.__enter__.call_count, 2)
+
+    def test_0030_broken_connection_is_not_reused(self):
+        """
+        Tests that a connection which failed is not put back to the pool
+        """
+        pool = SessionPool()
+        order_api = mock_order_api()
+
+        with self.assertRaises(IOError):
+            with pool.resource(order_api, 'url', 'user', 'key'):
+                raise IOError
+
+        with pool.resource(order_api, 'url', 'user', 'key'):
+            pass
+
+        self.assertEqual(order_api.return_value.__enter__.call_count, 2)
+
+    def test_0040_connection_timeout(self):
+        """
+        Tests that the timeout is put on the connection of the session and
+        updated when the session is reused
+        """
+        pool = SessionPool()
+        order_api = mock_order_api()
+
+        with pool.resource(order_api, 'https://url', 'user', 'key', 10):
+            pass
+
+        transport = order_api.call_args[1]['transport']
+        self.assertTrue(isinstance(transport, SafeTimeoutTransport))
+        self.assertEqual(transport.make_connection('url').timeout, 10)
+
+        with pool.resource(order_api, 'https://url', 'user', 'key', 5):
+            pass
+
+        self.assertEqual(transport.make_connection('url').timeout, 5)
+
+        # A plain http url gets a plain transport
+        with pool.resource(order_api, 'http://url', 'user', 'key', 5):
+            pass
+        transport = order_api.call_args[1]['transport']
+        self.assertFalse(isinstance(transport, SafeTimeoutTransport))
+        self.assertTrue(isinstance(transport, TimeoutTransport))
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSessionPool)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -101,6 +101,46 @@ class TestCountry(TestBase):
                 None
             )
 
+    def test_0050_search_using_magento_code_after_write(self):
+        """
+        Tests that memoized countries and states are refreshed once they
+        are modified
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            country = self.Country.search_using_magento_code('US')
+            self.assertEqual(country, self.country1)
+            self.assertEqual(
+                self.Subdivision.search_using_magento_region(
+                    'Florida', country
+                ),
+                self.subdivision1
+            )
+
+            self.Country.write([self.country1], {'code': 'UM'})
+            self.Subdivision.write([self.subdivision1], {'name': 'Georgia'})
+
+            self.assertRaises(
+                UserError,
+                self.Country.search_using_magento_code, 'US'
+            )
+            self.assertEqual(
+                self.Country.search_using_magento_code('UM'), self.country1
+            )
+            self.assertEqual(
+                self.Subdivision.search_using_magento_region(
+                    'Florida', country
+                ),
+                None
+            )
+            self.assertEqual(
+                self.Subdivision.search_using_magento_region(
+                    'Georgia', country
+                ),
+                self.subdivision1
+            )
+
 
 def suite():
     """
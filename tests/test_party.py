@@ -3,6 +3,8 @@ import os
 import sys
 import unittest
 
+import magento
+from mock import patch, MagicMock
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
@@ -18,6 +20,22 @@ if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
 
+def mock_customer_api(mock=None, data=None):
+    if mock is None:
+        mock = MagicMock(spec=magento.Customer)
+
+    handle = MagicMock(spec=magento.Customer)
+    handle.multiCall.side_effect = lambda calls: [
+        load_json('customers', str(args[0])) for method, args in calls
+    ]
+    if data is None:
+        handle.__enter__.return_value = handle
+    else:
+        handle.__enter__.return_value = data
+    mock.return_value = handle
+    return mock
+
+
 class TestParty(TestBase):
     """
     Tests party
@@ -225,6 +243,21 @@ class TestParty(TestBase):
             self.assertEqual(len(self.party.addresses), 2)
             self.assertEqual(len(self.party.contact_mechanisms), 1)
 
+            # The fingerprint follows the changes of the address
+            Address.write([address], {'street': 'another street'})
+            Address.find_or_create_for_party_using_magento_data(
+                self.party, address_data
+            )
+            self.assertEqual(len(self.party.addresses), 3)
+
+            address_data['street'] = 'another street'
+            self.assertEqual(
+                Address.find_or_create_for_party_using_magento_data(
+                    self.party, address_data
+                ), address
+            )
+            self.assertEqual(len(self.party.addresses), 3)
+
     def test0040_match_address(self):
         """
         Tests if address matching works as expected
@@ -283,6 +316,39 @@ class TestParty(TestBase):
                 address.match_with_magento_data(load_json('addresses', '1e'))
             )
 
+    def test0050_find_or_create_parties_in_bulk(self):
+        """
+        Tests that only the customers not imported yet are fetched from
+        magento
+        """
+        MagentoParty = POOL.get('sale.channel.magento.party')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+
+            self.setup_defaults()
+
+            Transaction().context.update({
+                'current_channel': self.channel1.id
+            })
+
+            party1 = self.Party.find_or_create_using_magento_data(
+                load_json('customers', '1')
+            )
+
+            customer_api = mock_customer_api()
+            with patch('magento.Customer', customer_api, create=True):
+                parties = self.Party.find_or_create_using_magento_ids(
+                    ['1', '2', '2', None]
+                )
+
+            self.assertEqual(set(parties.keys()), set([1, 2]))
+            self.assertEqual(parties[1], party1)
+            self.assertEqual(MagentoParty.search([], count=True), 2)
+
+            customer_api.return_value.multiCall.assert_called_once_with(
+                [['customer.info', [2]]]
+            )
+
 
 def suite():
     """
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+import socket
+from contextlib import nested
+import threading
 from decimal import Decimal
 
 import unittest
@@ -28,6 +31,8 @@ def mock_inventory_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Inventory)
     handle.update.side_effect = lambda id, data: True
+    handle.update_multi.side_effect = \
+        lambda inventory: [True for product in inventory]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -43,6 +48,24 @@ def mock_product_api(mock=None, data=None):
     handle = MagicMock(spec=magento.Product)
     handle.info.side_effect = \
         lambda id, identifierType: load_json('products', str(id))
+    handle.multiCall.side_effect = lambda calls: [
+        load_json('products', str(args[0])) for method, args in calls
+    ]
+    if data is None:
+        handle.__enter__.return_value = handle
+    else:
+        handle.__enter__.return_value = data
+    mock.return_value = handle
+    return mock
+
+
+def mock_category_api(mock=None, data=None):
+    if mock is None:
+        mock = MagicMock(spec=magento.Category)
+
+    handle = MagicMock(spec=magento.Category)
+    handle.tree.side_effect = \
+        lambda root_id: load_json('categories', 'category_tree')
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -56,6 +79,55 @@ class TestProduct(TestBase):
     Tests the methods of product
     '''
 
+    def create_listings(self, channel, codes):
+        """
+        Creates a product for each of the given codes, listed as a simple
+        product on the channel
+
+        :return: List of active records of listings
+        """
+        ProductTemplate = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+
+        template, = ProductTemplate.create([{
+            'name': 'Test product',
+            'type': 'goods',
+            'account_expense': self.get_account_by_kind('expense'),
+            'account_revenue': self.get_account_by_kind('revenue'),
+            'default_uom': self.uom.id,
+            'sale_uom': self.uom.id,
+            'products': [('create', [{
+                'code': code,
+                'description': 'This is a product description',
+                'list_price': Decimal('100'),
+                'cost_price': Decimal('1'),
+            } for code in codes])]
+        }])
+        return Listing.create([{
+            'channel': channel.id,
+            'product': product.id,
+            'product_identifier': product.code,
+            'magento_product_type': 'simple',
+            'state': 'active',
+        } for product in template.products])
+
+    def create_stock(self, product, quantity):
+        """
+        Puts the given quantity of the product in the warehouse
+        """
+        Move = POOL.get('stock.move')
+        Location = POOL.get('stock.location')
+
+        lost_found, = Location.search([('type', '=', 'lost_found')])
+        Move.do(Move.create([{
+            'product': product.id,
+            'uom': self.uom.id,
+            'quantity': quantity,
+            'from_location': lost_found.id,
+            'to_location': self.warehouse.storage_location.id,
+            'company': self.company.id,
+        }]))
+
     def test_0010_import_product_categories(self):
         """
         Test the import of product category using magento data
@@ -459,6 +531,450 @@ class TestProduct(TestBase):
                     listing.product.list_price * Decimal('0.9'), tier.price
                 )
 
+    def test_0100_import_products_resume(self):
+        """
+        Tests that the products are imported page by page and that an
+        interrupted import resumes after the last imported product
+        """
+        Product = POOL.get('product.product')
+
+        magento_products = [
+            {'product_id': '27', 'sku': 'VGN-TXN27N-B'},
+            {'product_id': '162', 'sku': 'micronmouse5000'},
+            {'product_id': '166', 'sku': 'HTC Touch Diamond'},
+        ]
+
+        def list_products(filters=None):
+            # Magento applies the filter on product_id
+            after = int(
+                (filters or {}).get('product_id', {}).get('gt', 0)
+            )
+            return [
+                product for product in magento_products
+                if int(product['product_id']) > after
+            ]
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            self.channel1.magento_product_import_page_size = 1
+            # The import was interrupted after the first product
+            self.channel1.magento_last_product_import_id = 27
+            self.channel1.save()
+
+            product_api = mock_product_api()
+            product_api.return_value.list.side_effect = list_products
+
+            with txn.set_context({'company': self.company.id}), \
+                    patch('magento.Product', product_api, create=True), \
+                    patch('magento.Category', mock_category_api(),
+                          create=True), \
+                    patch.object(txn.cursor, 'commit') as commit:
+                products = self.channel1.import_products()
+
+            product_api.return_value.list.assert_called_once_with({
+                'product_id': {'gt': 27},
+            })
+            # The products are fetched in bulk, one request per page
+            self.assertEqual(
+                product_api.return_value.multiCall.call_count, 2
+            )
+            self.assertFalse(product_api.return_value.info.called)
+            self.assertEqual(
+                sorted(product.code for product in products),
+                ['HTC Touch Diamond', 'micronmouse5000']
+            )
+            self.assertEqual(Product.search([], count=True), 2)
+
+            # One commit per page
+            self.assertEqual(commit.call_count, 2)
+
+            # The import is complete, the next one starts afresh
+            channel = self.Channel(self.channel1.id)
+            self.assertIsNone(channel.magento_last_product_import_id)
+
+    def test_0110_export_bulk_inventory(self):
+        """
+        Tests that the inventory is pushed in bulk, remembered on the
+        listings, and only pushed again once it changes
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listing1, listing2 = self.create_listings(
+                    self.channel1, ['product-1', 'product-2']
+                )
+                self.create_stock(listing1.product, 5)
+
+                inventory_api = mock_inventory_api()
+                update_multi = inventory_api.return_value.update_multi
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing1, listing2])
+
+                    update_multi.assert_called_once_with([
+                        ['product-1', {'qty': 5, 'is_in_stock': '1'}],
+                        ['product-2', {'qty': 0, 'is_in_stock': '0'}],
+                    ])
+
+                    listing1, listing2 = Listing.browse(
+                        map(int, [listing1, listing2])
+                    )
+                    self.assertEqual(listing1.magento_exported_quantity, 5)
+                    self.assertTrue(listing1.magento_exported_in_stock)
+                    self.assertEqual(listing2.magento_exported_quantity, 0)
+                    self.assertFalse(listing2.magento_exported_in_stock)
+
+                    # Nothing changed, nothing is pushed
+                    Listing.export_bulk_inventory([listing1, listing2])
+                    self.assertEqual(update_multi.call_count, 1)
+
+                    # Only the listing whose stock changed is pushed
+                    self.create_stock(listing2.product, 3)
+                    Listing.export_bulk_inventory([listing1, listing2])
+                    update_multi.assert_called_with([
+                        ['product-2', {'qty': 3, 'is_in_stock': '1'}],
+                    ])
+
+    def test_0115_export_inventory_resync(self):
+        """
+        Tests that the inventory of a single listing is always sent, and
+        that the exported inventory is forgotten when the listing changes
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listing, = self.create_listings(self.channel1, ['product-1'])
+
+                inventory_api = mock_inventory_api()
+                update_multi = inventory_api.return_value.update_multi
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing])
+                    self.assertEqual(update_multi.call_count, 1)
+
+                    # The listing is exported again even if nothing changed
+                    Listing(listing.id).export_inventory()
+                    self.assertEqual(update_multi.call_count, 2)
+
+                    Listing.export_bulk_inventory([listing])
+                    self.assertEqual(update_multi.call_count, 2)
+
+                    Listing.write([listing], {
+                        'product_identifier': 'product-1-new',
+                    })
+                    listing = Listing(listing.id)
+                    self.assertIsNone(listing.magento_exported_quantity)
+                    self.assertIsNone(listing.magento_exported_in_stock)
+
+                    Listing.export_bulk_inventory([listing])
+                    update_multi.assert_called_with([
+                        ['product-1-new', {'qty': 0, 'is_in_stock': '0'}],
+                    ])
+
+    def test_0120_export_bulk_inventory_batch_size(self):
+        """
+        Tests that the inventory is pushed in batches of the inventory batch
+        size of the channel, and that the adaptive batch size grows after a
+        fast batch and shrinks after a failed one
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listings = self.create_listings(
+                    self.channel1, ['product-%d' % i for i in range(5)]
+                )
+
+                self.channel1.magento_inventory_batch_size = 2
+                self.channel1.save()
+
+                batch_sizes = []
+
+                def update_multi(inventory):
+                    batch_sizes.append(len(inventory))
+                    return [True for product in inventory]
+
+                inventory_api = mock_inventory_api()
+                inventory_api.return_value.update_multi.side_effect = \
+                    update_multi
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory(listings)
+                self.assertEqual(batch_sizes, [2, 2, 1])
+
+                self.channel1.magento_inventory_batch_size = 4
+                self.channel1.magento_inventory_adaptive_batch = True
+                self.channel1.save()
+                Listing.write(listings, {
+                    'magento_exported_quantity': None,
+                    'magento_exported_in_stock': None,
+                })
+
+                batch_sizes = []
+
+                def update_multi_timeout(inventory):
+                    batch_sizes.append(len(inventory))
+                    if len(batch_sizes) == 1:
+                        raise socket.timeout
+                    return [True for product in inventory]
+
+                inventory_api.return_value.update_multi.side_effect = \
+                    update_multi_timeout
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory(listings)
+
+                # The batch which timed out is retried with half the size,
+                # which then doubles as magento answers in time
+                self.assertEqual(batch_sizes, [4, 2, 3])
+                self.assertEqual(
+                    set(listing.magento_exported_quantity
+                        for listing in Listing.browse(map(int, listings))),
+                    set([0])
+                )
+
+    def test_0130_export_bulk_inventory_faults(self):
+        """
+        Tests that the listings of products missing on magento are disabled
+        with a single write, and that the other faults are skipped
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listings = self.create_listings(
+                    self.channel1, ['product-%d' % i for i in range(4)]
+                )
+
+                self.channel1.magento_inventory_batch_size = 2
+                self.channel1.save()
+
+                missing = {
+                    'isFault': True, 'faultCode': '101',
+                    'faultMessage': 'Product not exists.',
+                }
+                not_saved = {
+                    'isFault': True, 'faultCode': '102',
+                    'faultMessage': 'Product not updated.',
+                }
+                inventory_api = mock_inventory_api()
+                inventory_api.return_value.update_multi.side_effect = [
+                    [True, missing], [missing, not_saved],
+                ]
+                with nested(
+                    patch('magento.Inventory', inventory_api, create=True),
+                    patch.object(Listing, 'write', side_effect=Listing.write),
+                ) as (_, write):
+                    Listing.export_bulk_inventory(listings)
+
+                disable_writes = [
+                    args for args, kwargs in write.call_args_list
+                    if args[1] == {'state': 'disabled'}
+                ]
+                self.assertEqual(len(disable_writes), 1)
+
+                listings = Listing.browse(map(int, listings))
+                self.assertEqual(
+                    [listing.state for listing in listings],
+                    ['active', 'disabled', 'disabled', 'active']
+                )
+                self.assertEqual(
+                    [listing.magento_exported_quantity
+                        for listing in listings],
+                    [0, None, None, None]
+                )
+
+    def test_0135_export_bulk_inventory_channel_error(self):
+        """
+        Tests that a channel whose push fails as a whole does not affect the
+        other channels
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listing1, = self.create_listings(self.channel1, ['product-1'])
+                listing2, = self.create_listings(self.channel2, ['product-2'])
+
+                def update_multi(inventory):
+                    if inventory[0][0] == 'product-2':
+                        raise IOError
+                    return [True for product in inventory]
+
+                inventory_api = mock_inventory_api()
+                inventory_api.return_value.update_multi.side_effect = \
+                    update_multi
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing1, listing2])
+
+                self.assertEqual(
+                    [listing.magento_exported_quantity for listing in
+                        Listing.browse(map(int, [listing1, listing2]))],
+                    [0, None]
+                )
+
+    def test_0140_export_bulk_inventory_channels(self):
+        """
+        Tests that the inventory of several channels is pushed at the same
+        time
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listing1, = self.create_listings(self.channel1, ['product-1'])
+                listing2, = self.create_listings(self.channel2, ['product-2'])
+
+                other_channel_pushing = threading.Event()
+                waits = []
+                lock = threading.Lock()
+
+                def update_multi(inventory):
+                    with lock:
+                        first = not waits
+                        waits.append(None)
+                    if first:
+                        # Wait for the push of the other channel to start
+                        waits[0] = other_channel_pushing.wait(5)
+                    else:
+                        other_channel_pushing.set()
+                    return [True for product in inventory]
+
+                inventory_api = mock_inventory_api()
+                inventory_api.return_value.update_multi.side_effect = \
+                    update_multi
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing1, listing2])
+
+                self.assertEqual(waits, [True, None])
+                self.assertEqual(
+                    [listing.magento_exported_quantity for listing in
+                        Listing.browse(map(int, [listing1, listing2]))],
+                    [0, 0]
+                )
+
+    def test_0150_export_bulk_inventory_other_channels(self):
+        """
+        Tests that the listings of channels which are not magento channels
+        are exported by their own channel
+        """
+        Channel = POOL.get('sale.channel')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}), \
+                    patch.object(Channel, 'get_source', return_value=[
+                        ('manual', 'Manual'), ('magento', 'Magento'),
+                        ('other', 'Other'),
+                    ]):
+                other_channel, = Channel.create([{
+                    'name': 'Other channel',
+                    'price_list': self.price_list,
+                    'invoice_method': 'order',
+                    'shipment_method': 'order',
+                    'source': 'other',
+                    'warehouse': self.warehouse,
+                    'payment_term': self.payment_term,
+                    'company': self.company.id,
+                }])
+                listing1, = self.create_listings(self.channel1, ['product-1'])
+                listing2, = self.create_listings(other_channel, ['product-2'])
+
+                inventory_api = mock_inventory_api()
+                with nested(
+                    patch('magento.Inventory', inventory_api, create=True),
+                    patch.object(Listing, 'export_inventory'),
+                ) as (_, export):
+                    Listing.export_bulk_inventory([listing1, listing2])
+
+                update_multi = inventory_api.return_value.update_multi
+                update_multi.assert_called_once_with([
+                    ['product-1', {'qty': 0, 'is_in_stock': '0'}],
+                ])
+                self.assertEqual(export.call_count, 1)
+
+    def test_0160_export_bulk_inventory_quantities(self):
+        """
+        Tests that the quantities are computed with one stock computation
+        per availability context of the listings
+        """
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+
+        get_availability_context = Listing.get_availability_context
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'company': self.company.id}):
+                listings = self.create_listings(
+                    self.channel1, ['product-1', 'product-2']
+                ) + self.create_listings(
+                    self.channel2, ['product-3', 'product-4']
+                )
+                for listing in listings:
+                    self.create_stock(listing.product, 2)
+
+                # The channels share the warehouse
+                with nested(
+                    patch('magento.Inventory', mock_inventory_api(),
+                          create=True),
+                    patch.object(
+                        Product, 'get_quantity',
+                        side_effect=Product.get_quantity
+                    ),
+                ) as (_, get_quantity):
+                    Listing.export_bulk_inventory(listings)
+
+                self.assertEqual(get_quantity.call_count, 1)
+                self.assertEqual(
+                    [listing.magento_exported_quantity
+                        for listing in Listing.browse(map(int, listings))],
+                    [2, 2, 2, 2]
+                )
+
+                # The stock of the second channel is counted elsewhere
+                def availability_context(listing):
+                    if listing.channel == self.channel2:
+                        return {'locations': [
+                            self.warehouse.output_location.id
+                        ]}
+                    return get_availability_context(listing)
+
+                with nested(
+                    patch('magento.Inventory', mock_inventory_api(),
+                          create=True),
+                    patch.object(
+                        Listing, 'get_availability_context',
+                        autospec=True, side_effect=availability_context
+                    ),
+                    patch.object(
+                        Product, 'get_quantity',
+                        side_effect=Product.get_quantity
+                    ),
+                ) as (_, _, get_quantity):
+                    Listing.export_bulk_inventory(listings)
+
+                self.assertEqual(get_quantity.call_count, 2)
+                self.assertEqual(
+                    [listing.magento_exported_quantity
+                        for listing in Listing.browse(map(int, listings))],
+                    [2, 2, 0, 0]
+                )
+
 
 def suite():
     """Test Suite"""
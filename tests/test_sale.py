@@ -3,7 +3,11 @@ import sys
 import os
 from decimal import Decimal
 
+import json
+import time
+import threading
 import unittest
+from contextlib import nested
 from datetime import datetime
 import pytz
 from dateutil.relativedelta import relativedelta
@@ -32,6 +36,9 @@ def mock_product_api(mock=None, data=None):
     handle = MagicMock(spec=magento.Product)
     handle.info.side_effect = \
         lambda sku, identifierType: load_json('products', sku)
+    handle.multiCall.side_effect = lambda calls: [
+        load_json('products', args[0]) for method, args in calls
+    ]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -40,12 +47,28 @@ def mock_product_api(mock=None, data=None):
     return mock
 
 
+def order_info_or_fault(increment_id):
+    """
+    Returns the order data like magento does for every order of a multiCall
+    """
+    try:
+        return load_json('orders', str(increment_id))
+    except IOError:
+        return {
+            'isFault': True,
+            'faultCode': '100',
+            'faultMessage': 'Requested order not exists.',
+        }
+
+
 def mock_order_api(mock=None, data=None):
     if mock is None:
         mock = MagicMock(spec=magento.Order)
 
     handle = MagicMock(spec=magento.Order)
     handle.info.side_effect = lambda id: load_json('orders', str(id))
+    handle.info_multi.side_effect = \
+        lambda ids: [order_info_or_fault(id) for id in ids]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -60,6 +83,9 @@ def mock_customer_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Customer)
     handle.info.side_effect = lambda id: load_json('customers', str(id))
+    handle.multiCall.side_effect = lambda calls: [
+        load_json('customers', str(args[0])) for method, args in calls
+    ]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -74,6 +100,9 @@ def mock_shipment_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Shipment)
     handle.create.side_effect = lambda *args, **kwargs: 'Shipment created'
+    handle.multiCall.side_effect = lambda calls: [
+        'Shipment created' for call in calls
+    ]
     handle.addtrack.side_effect = lambda *args, **kwargs: True
     if data is None:
         handle.__enter__.return_value = handle
@@ -89,6 +118,7 @@ def mock_tier_price_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.ProductTierPrice)
     handle.update.side_effect = lambda *args, **kwargs: 'Prices Exported'
+    handle.multiCall.side_effect = lambda calls: [True for call in calls]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -717,6 +747,10 @@ class TestSale(TestBase):
                     shipment = Shipment(shipment.id)
                     self.assertTrue(shipment.magento_increment_id)
 
+                    shipment_api = magento.Shipment.return_value
+                    self.assertEqual(shipment_api.multiCall.call_count, 1)
+                    self.assertFalse(shipment_api.create.called)
+
     def test_0070_export_order_status_with_last_order_export_time_case2(self):
         """
         Tests that sale can be exported if last order export time is
@@ -1065,6 +1099,18 @@ class TestSale(TestBase):
                         self.channel1.export_product_prices()
 
                     self.assertEqual(product_listings, 2)
+
+                    tier_price_api = magento.ProductTierPrice.return_value
+                    self.assertEqual(tier_price_api.multiCall.call_count, 1)
+                    self.assertFalse(tier_price_api.update.called)
+
+                    # Prices did not change, so nothing is exported again
+                    self.channel1.last_product_price_export_time = None
+                    self.channel1.save()
+                    self.assertEqual(
+                        self.channel1.export_product_prices(), 0
+                    )
+                    self.assertEqual(tier_price_api.multiCall.call_count, 1)
                 self.assertEqual(
                     self.channel1.last_product_price_export_time.date(),
                     datetime.utcnow().date()
@@ -1456,6 +1502,554 @@ class TestSale(TestBase):
                     m_sale.sale_date, utc_sale_time
                 )
 
+    def test_0150_import_orders_in_batches(self):
+        """
+        Tests that order details are fetched in batches and the orders
+        magento reports a fault for are skipped
+        """
+        Sale = POOL.get('sale.sale')
+        Party = POOL.get('party.party')
+        Channel = POOL.get('sale.channel')
+        Category = POOL.get('product.category')
+
+        get_product = Channel.get_product
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            self.channel1.magento_batch_size = 1
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_summaries = []
+                for increment_id in ('100000001', '300000001'):
+                    order_data = load_json('orders', increment_id)
+                    order_summaries.append({
+                        'order_id': order_data['order_id'],
+                        'increment_id': order_data['increment_id'],
+                    })
+                order_summaries.append({
+                    'order_id': '999', 'increment_id': '999999999',
+                })
+
+                order_api = mock_order_api()
+                product_api = mock_product_api()
+                with nested(
+                    patch('magento.Order', order_api, create=True),
+                    patch('magento.Customer', mock_customer_api(), create=True),
+                    patch('magento.Product', product_api, create=True),
+                    patch.object(
+                        Party, 'find_or_create_using_magento_id',
+                        side_effect=Party.find_or_create_using_magento_id
+                    ),
+                    patch.object(
+                        Channel, 'get_product',
+                        side_effect=lambda sku: get_product(
+                            Channel(self.channel1.id), sku
+                        )
+                    ),
+                ) as (_, _, _, find_or_create_party, channel_get_product):
+                    sales = self.channel1.import_magento_orders(
+                        order_summaries
+                    )
+
+                    self.assertEqual(len(sales), 2)
+                    self.assertEqual(Sale.search([], count=True), 2)
+
+                    # The customers resolved in bulk are used by the sales
+                    self.assertFalse(find_or_create_party.called)
+
+                    # The products resolved in bulk are used by the sale
+                    # lines, only the bundle BoMs look products up
+                    self.assertTrue(set(
+                        args[0] for args, kwargs in
+                        channel_get_product.call_args_list
+                    ).isdisjoint(
+                        ['HTC Touch Diamond', 'micronmouse5000', '2yr_p_l']
+                    ))
+                    self.assertEqual(
+                        order_api.return_value.info_multi.call_count, 3
+                    )
+                    self.assertFalse(order_api.return_value.info.called)
+
+                    # All the products are fetched in bulk
+                    self.assertEqual(
+                        product_api.return_value.multiCall.call_count, 5
+                    )
+                    self.assertFalse(product_api.return_value.info.called)
+
+                    # Imported orders are not fetched again
+                    sales = self.channel1.import_magento_orders(
+                        order_summaries
+                    )
+                    self.assertEqual(len(sales), 2)
+                    self.assertEqual(
+                        sorted(sale.magento_id for sale in sales), [1, 3]
+                    )
+                    self.assertEqual(
+                        order_api.return_value.info_multi.call_count, 4
+                    )
+
+    def test_0160_order_import_start(self):
+        """
+        Tests that orders are imported from the last import time with an
+        overlap
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.channel1.last_order_import_time = None
+            self.channel1.save()
+
+            self.assertEqual(
+                self.channel1.get_magento_order_import_start().date(),
+                (datetime.utcnow() - relativedelta(days=30)).date()
+            )
+
+            last_import_time = datetime(2016, 7, 12, 10, 0, 0)
+            self.channel1.last_order_import_time = last_import_time
+            self.channel1.save()
+
+            self.assertEqual(
+                self.channel1.get_magento_order_import_start(),
+                last_import_time - relativedelta(minutes=10)
+            )
+
+    def test_0170_order_summary_pages_resume(self):
+        """
+        Tests that order summaries are fetched page by page after the last
+        order of the previous page, starting after the last imported order
+        """
+        orders = [
+            {'order_id': str(order_id), 'increment_id': str(order_id)}
+            for order_id in (3, 7, 8, 12, 15)
+        ]
+
+        def search(filters, limit, page):
+            # Magento applies the filter on order_id and sorts by it
+            items = [
+                order for order in orders
+                if int(order['order_id']) > filters['order_id']['gt']
+            ]
+            return {'items': items[:2], 'hasNext': len(items) > 2}
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            order_api = MagicMock(spec=magento.Order)
+            order_api.search.side_effect = search
+
+            pages = []
+            for last_order_id, summaries in \
+                    self.channel1.get_magento_order_summary_pages(
+                        order_api, {}):
+                pages.append((
+                    last_order_id,
+                    [summary['order_id'] for summary in summaries]
+                ))
+                if last_order_id == 7:
+                    # An order of the next page leaves the filters while
+                    # this page is imported
+                    del orders[2]
+            self.assertEqual(pages, [(7, ['3', '7']), (15, ['12', '15'])])
+
+            # An interrupted import resumes after the last imported order
+            self.channel1.magento_last_order_import_id = 7
+            self.channel1.save()
+            order_api.search.reset_mock()
+
+            pages = list(
+                self.channel1.get_magento_order_summary_pages(order_api, {})
+            )
+            self.assertEqual(pages, [(15, orders[2:])])
+            order_api.search.assert_called_once_with(
+                filters={'order_id': {'gt': 7}}, limit=3000, page=1
+            )
+
+    def test_0180_tryton_action_after_order_state_write(self):
+        """
+        Tests that the tryton action of an order state reflects the changes
+        made to the order state
+        """
+        OrderState = POOL.get('sale.channel.order_state')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            self.assertEqual(
+                self.channel1.get_tryton_action('new')['action'],
+                'process_manually'
+            )
+
+            order_state, = OrderState.search([
+                ('code', '=', 'new'),
+                ('channel', '=', self.channel1.id),
+            ])
+            OrderState.write([order_state], {'action': 'do_not_import'})
+
+            self.assertEqual(
+                self.channel1.get_tryton_action('new')['action'],
+                'do_not_import'
+            )
+
+    def test_0190_retry_failed_orders(self):
+        """
+        Tests that the orders which failed in an earlier import are imported
+        by the next one, and that the import completes
+        """
+        Sale = POOL.get('sale.sale')
+        Channel = POOL.get('sale.channel')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            self.channel1.magento_order_import_retries = json.dumps([{
+                'order_id': '1', 'increment_id': '100000001',
+            }])
+            self.channel1.save()
+
+            order_api = mock_order_api()
+            order_api.return_value.search.side_effect = \
+                lambda filters, limit, page: {'items': [], 'hasNext': False}
+
+            with txn.set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                with nested(
+                    patch('magento.Order', order_api, create=True),
+                    patch('magento.Customer', mock_customer_api(), create=True),
+                    patch('magento.Product', mock_product_api(), create=True),
+                    patch.object(txn.cursor, 'commit'),
+                ):
+                    sales = self.channel1.import_orders()
+
+            self.assertEqual([sale.magento_id for sale in sales], [1])
+            self.assertEqual(Sale.search([], count=True), 1)
+
+            channel = Channel(self.channel1.id)
+            self.assertIsNone(channel.magento_order_import_retries)
+            self.assertTrue(channel.last_order_import_time)
+
+    def test_0200_magento_timeout_until_deadline(self):
+        """
+        Tests that the requests to magento time out at the deadline in the
+        context
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            self.channel1.magento_cron_timeout = 60
+            self.channel1.save()
+
+            self.assertEqual(self.channel1.get_magento_timeout(), 60)
+
+            with txn.set_context(magento_deadline=time.time() + 3600):
+                self.assertEqual(self.channel1.get_magento_timeout(), 60)
+
+            with txn.set_context(magento_deadline=time.time() + 10):
+                self.assertTrue(self.channel1.get_magento_timeout() <= 10)
+
+            # A deadline which has passed still leaves a second
+            with txn.set_context(magento_deadline=time.time() - 10):
+                self.assertEqual(self.channel1.get_magento_timeout(), 1)
+
+    def test_0205_export_shipment_status_using_cron(self):
+        """
+        Tests that the cron exports the shipment status of every channel,
+        each with a deadline counted from the moment a worker starts on it,
+        and that a channel which fails does not stop the others
+        """
+        Channel = POOL.get('sale.channel')
+
+        exports = {}
+
+        def export_shipment_status_to_magento(channel):
+            exports[channel.id] = (
+                time.time(), Transaction().context['magento_deadline']
+            )
+            time.sleep(1)
+            if channel.id == self.channel1.id:
+                raise Exception
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            Channel.write([self.channel1, self.channel2], {
+                'magento_cron_timeout': 10,
+            })
+
+            with nested(
+                patch(
+                    'trytond.modules.magento.channel.CRON_CHANNEL_WORKERS', 1
+                ),
+                patch.object(
+                    Channel, 'export_shipment_status_to_magento',
+                    autospec=True,
+                    side_effect=export_shipment_status_to_magento
+                ),
+            ):
+                Channel.export_shipment_status_to_magento_using_cron()
+
+            self.assertEqual(
+                set(exports), set([self.channel1.id, self.channel2.id])
+            )
+            for started, deadline in exports.values():
+                # The channel started second waited for the other one, but
+                # still gets its whole timeout
+                self.assertAlmostEqual(deadline - started, 10, delta=0.5)
+
+    def test_0210_magento_tax_after_tax_mapping_write(self):
+        """
+        Tests that the tax of a rate reflects the changes made to the tax
+        mapping of the channel
+        """
+        Tax = POOL.get('account.tax')
+        TaxMapping = POOL.get('sale.channel.tax')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            tax1, tax2 = Tax.create([{
+                'name': name,
+                'description': name,
+                'type': 'percentage',
+                'company': self.company.id,
+                'invoice_account': self.get_account_by_kind('revenue'),
+                'credit_note_account': self.get_account_by_kind('revenue'),
+                'rate': Decimal('0.1'),
+            } for name in ('tax1', 'tax2')])
+
+            tax_mapping, = TaxMapping.create([{
+                'name': 'magento_tax',
+                'rate': Decimal('0.1'),
+                'tax': tax1.id,
+                'channel': self.channel1.id,
+            }])
+
+            self.assertEqual(
+                self.channel1.get_magento_tax(Decimal('0.1')), tax1
+            )
+
+            TaxMapping.write([tax_mapping], {'tax': tax2.id})
+
+            self.assertEqual(
+                self.channel1.get_magento_tax(Decimal('0.1')), tax2
+            )
+
+    def test_0220_update_order_status(self):
+        """
+        Tests that the shipments of the orders complete on magento are done
+        with one call per transition, and that the orders are fetched in
+        batches of the batch size of the channel
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            self.channel1.magento_batch_size = 1
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_summaries = []
+                for increment_id in ('100000001', '100000002'):
+                    order_data = load_json('orders', increment_id)
+                    order_summaries.append({
+                        'order_id': order_data['order_id'],
+                        'increment_id': order_data['increment_id'],
+                    })
+
+                with nested(
+                    patch('magento.Order', mock_order_api(), create=True),
+                    patch('magento.Customer', mock_customer_api(), create=True),
+                    patch('magento.Product', mock_product_api(), create=True),
+                ):
+                    sales = self.channel1.import_magento_orders(
+                        order_summaries
+                    )
+
+                Sale.write(sales, {'invoice_method': 'manual'})
+                sales = Sale.browse(map(int, sales))
+                Sale.confirm(sales)
+                with Transaction().set_user(0, set_context=True):
+                    Sale.process(sales)
+
+                shipments = Shipment.search([])
+                self.assertEqual(len(shipments), 2)
+
+                order_api = mock_order_api()
+                order_api.return_value.info_multi.side_effect = \
+                    lambda ids: [
+                        dict(load_json('orders', id), status='complete')
+                        for id in ids
+                    ]
+                with nested(
+                    patch('magento.Order', order_api, create=True),
+                    patch.object(
+                        Shipment, 'assign', side_effect=Shipment.assign
+                    ),
+                    patch.object(Shipment, 'pack', side_effect=Shipment.pack),
+                    patch.object(Shipment, 'done', side_effect=Shipment.done),
+                ) as (_, assign, pack, done):
+                    self.channel1.update_order_status()
+
+                self.assertEqual(
+                    order_api.return_value.info_multi.call_count, 2
+                )
+                for transition in (assign, pack, done):
+                    self.assertEqual(transition.call_count, 1)
+                    self.assertEqual(len(transition.call_args[0][0]), 2)
+
+                self.assertEqual(
+                    set(shipment.state for shipment in
+                        Shipment.browse(map(int, shipments))),
+                    set(['done'])
+                )
+
+    def test_0230_create_magento_shipments(self):
+        """
+        Tests that the shipments are created on magento with the customer
+        notified, and that an already existing shipment is not reported
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            shipment_api = mock_shipment_api()
+            shipment_api.return_value.multiCall.side_effect = None
+            shipment_api.return_value.multiCall.return_value = [
+                '200000001', {
+                    'isFault': True, 'faultCode': '102',
+                    'faultMessage': 'Cannot do shipment for the order.',
+                }
+            ]
+            with nested(
+                patch('magento.Shipment', shipment_api, create=True),
+                patch('trytond.modules.magento.channel.logger'),
+            ) as (_, logger):
+                exported_shipments = self.channel1.create_magento_shipments([
+                    ('shipment 1', '100000001', {'1': 1.0}),
+                    ('shipment 2', '100000002', {'2': 2.0}),
+                ])
+
+            shipment_api.return_value.multiCall.assert_called_once_with([
+                [
+                    'sales_order_shipment.create',
+                    ['100000001', {'1': 1.0}, '', True, False]
+                ], [
+                    'sales_order_shipment.create',
+                    ['100000002', {'2': 2.0}, '', True, False]
+                ],
+            ])
+            self.assertEqual(
+                exported_shipments, [('shipment 1', '200000001')]
+            )
+            self.assertFalse(logger.warning.called)
+
+    def test_0240_import_orders_in_parallel(self):
+        """
+        Tests that orders imported by several workers are imported by the
+        same worker for a customer, that an order imported concurrently is
+        found again, and that the orders which fail are recorded
+        """
+        Sale = POOL.get('sale.sale')
+        Channel = POOL.get('sale.channel')
+
+        orders_data = [{
+            'order_id': order_id,
+            'increment_id': '10000000%s' % order_id,
+            'customer_id': customer_id,
+        } for order_id, customer_id in [
+            ('1', '5'), ('2', '5'), ('3', '6'), ('4', None),
+        ]]
+
+        imports = []
+
+        def find_or_create_using_magento_data(order_data, **kwargs):
+            imports.append(
+                (order_data['order_id'], threading.current_thread().ident)
+            )
+            if order_data['order_id'] in ('3', '4'):
+                # Lost the race to another import, or failed
+                raise Exception
+            return Sale(int(order_data['order_id']))
+
+        def find_using_magento_data(order_data):
+            if order_data['order_id'] == '3':
+                return Sale(3)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            self.channel1.magento_order_import_workers = 2
+            self.channel1.save()
+
+            with nested(
+                patch.object(
+                    Sale, 'find_or_create_using_magento_data',
+                    side_effect=find_or_create_using_magento_data
+                ),
+                patch.object(
+                    Sale, 'find_using_magento_data',
+                    side_effect=find_using_magento_data
+                ),
+                patch.object(txn.cursor, 'commit'),
+            ):
+                sales = self.channel1.import_magento_orders_in_parallel(
+                    orders_data
+                )
+
+            self.assertEqual(
+                [sale and sale.id for sale in sales], [1, 2, 3, None]
+            )
+
+            # The orders of a customer are imported in sequence by the
+            # same worker
+            customer_imports = [
+                (order_id, thread) for order_id, thread in imports
+                if order_id in ('1', '2')
+            ]
+            self.assertEqual(
+                [order_id for order_id, thread in customer_imports],
+                ['1', '2']
+            )
+            self.assertEqual(
+                customer_imports[0][1], customer_imports[1][1]
+            )
+            self.assertNotIn(
+                threading.current_thread().ident,
+                [thread for order_id, thread in imports]
+            )
+
+            channel = Channel(self.channel1.id)
+            self.assertEqual(
+                json.loads(channel.magento_order_import_retries), [{
+                    'order_id': '4', 'increment_id': '100000004',
+                }]
+            )
+
 
 def suite():
     """